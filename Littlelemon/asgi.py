@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Littlelemon.settings')
 
 application = get_asgi_application()
+
+# the OpenAPI schema is generated on deploy, every process loads it once before serving requests
+from LittlelemonAPI.schema import load_schema  # noqa: E402
+
+load_schema()
@@ -9,6 +9,8 @@ https://docs.djangoproject.com/en/4.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
+import os
+import sys
 from datetime import timedelta
 from pathlib import Path
 
@@ -22,9 +24,11 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-(e6cn2(=_qfohxxl-bon-!_%8ks9gd35(f8%6qf451$_c_*$-('
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# set DJANGO_DEBUG=False to run the production profile,
+# with DJANGO_ALLOWED_HOSTS set to the host names separated by commas (e.g. "example.com,www.example.com")
+DEBUG = os.environ.get('DJANGO_DEBUG', 'True').lower() in ('1', 'true', 'yes')
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host.strip() for host in os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',') if host.strip()]
 
 # Application definition
 
@@ -59,6 +63,8 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'Littlelemon.urls'
 
+# without a 'loaders' option Django (4.1+) wraps the loaders in the cached loader,
+# so every template is compiled only once per process (and reloaded when it changes with DEBUG on)
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -89,6 +95,68 @@ DATABASES = {
     }
 }
 
+# the migrations of LittlelemonAPI are not in the repository (every environment runs makemigrations),
+# so "manage.py test" creates its tables directly from the models
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    MIGRATION_MODULES = {'LittlelemonAPI': None}
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# the local memory cache is per process, point the default cache to redis/memcached
+# when running more than one worker so the menu versions and rows are shared
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'littlelemon',
+        'OPTIONS': {
+            # the menu page keeps two entries for each menu item (its version key and its serialized row),
+            # plus the object cache, the lists and the facets: room for a catalogue of about 100k items
+            'MAX_ENTRIES': 250000,
+        },
+    }
+}
+
+# how long (in seconds) the menu lists are fresh in the cache,
+# and how long after that the stale list is still returned while one request rebuilds it
+MENU_CACHE_TIMEOUT = 60
+MENU_CACHE_STALE_TIMEOUT = 5 * 60
+
+# the price ranges of the menu filter facets: <10, 10-20, 20-50, 50-100, >=100
+MENU_PRICE_FACET_EDGES = [10, 20, 50, 100]
+
+# answer menu_items_filter_data from an in-memory copy of the menu in each worker (see catalogue_index.py)
+MENU_CATALOGUE_INDEX = False
+# the memory budget of that copy, checked by "manage.py benchmark_catalogue_index"
+MENU_CATALOGUE_INDEX_MAX_BYTES_PER_ITEM = 1024
+
+# the object cache of single menu items and categories (see LittlelemonAPI/object_cache.py):
+# the number of objects kept in each process, how long (in seconds) they stay in the shared cache,
+# and how long a missing object (404) is remembered
+OBJECT_CACHE_LOCAL_MAX_ENTRIES = 1000
+OBJECT_CACHE_TIMEOUT = 60 * 60
+OBJECT_CACHE_NEGATIVE_TIMEOUT = 30
+
+# how long (in seconds) a serialized menu item row is kept in the cache (see LittlelemonAPI/menu_rows.py)
+MENU_ROW_CACHE_TIMEOUT = 60 * 60
+
+# Background exports (see LittlelemonAPI/exports.py)
+# where the export files are written, how many worker processes run them,
+# how many jobs can wait or run at the same time (per web worker) and how long (in seconds) the results are kept
+EXPORT_ROOT = BASE_DIR / 'exports'
+EXPORT_MAX_WORKERS = 2
+EXPORT_MAX_PENDING_JOBS = 10
+EXPORT_RESULT_TTL = 60 * 60
+EXPORT_CHUNK_SIZE = 1000
+
+# the OpenAPI schema generated on deploy by "manage.py generate_openapi_schema" (see LittlelemonAPI/schema.py)
+OPENAPI_SCHEMA_PATH = BASE_DIR / 'openapi-schema.json'
+
+# Batch endpoint (see LittlelemonAPI/batch.py)
+# the maximum number of sub-requests in one batch and of reads running at the same time
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = 4
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -132,6 +200,11 @@ INTERNAL_IPS = [
     '127.0.0.1',
 ]
 
+DEBUG_TOOLBAR_CONFIG = {
+    # the tests run with DEBUG = False, so the toolbar is never shown and can stay installed
+    'IS_RUNNING_TESTS': False,
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
@@ -183,4 +256,15 @@ SIMPLE_JWT = {
     # 'ROTATE_REFRESH_TOKENS': False,
     # 'BLACKLIST_AFTER_ROTATION': False,
     # 'UPDATE_LAST_LOGIN': False,
-}
\ No newline at end of file
+}
+
+# Expired tokens purge (see LittlelemonAPI/token_maintenance.py)
+# TOKEN_PURGE_INTERVAL: purge every N seconds in the web process, None to only purge with
+# "manage.py purge_expired_tokens" (e.g. from cron)
+TOKEN_PURGE_INTERVAL = None
+TOKEN_PURGE_BATCH_SIZE = 500
+# seconds between two batches
+TOKEN_PURGE_PAUSE = 0.05
+# the metrics of the purges (and the lock that lets only one process purge), shared by the command and the
+# web workers, so they need to run on the same host or share this directory
+TOKEN_PURGE_METRICS_PATH = BASE_DIR / 'token-purge' / 'metrics.json'
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Littlelemon.settings')
 
 application = get_wsgi_application()
+
+# the OpenAPI schema is generated on deploy, every process loads it once before serving requests
+from LittlelemonAPI.schema import load_schema  # noqa: E402
+
+load_schema()
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class LittlelemonapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'LittlelemonAPI'
+
+    def ready(self):
+        # connect the signal receivers that bump the menu versions
+        from LittlelemonAPI import signals  # noqa: F401
+        # purge the expired JWT tokens in the background if TOKEN_PURGE_INTERVAL is set
+        from LittlelemonAPI.token_maintenance import enable_periodic_purge
+        enable_periodic_purge()
@@ -0,0 +1,164 @@
+""" Run many API requests in one HTTP request.
+
+The front end needs 5-10 calls to show one screen, each one pays the TCP/TLS, authentication and middleware cost.
+POST /api/batch with
+    {"requests": [{"method": "GET", "path": "/api/menu-items?page=2"},
+                  {"method": "GET", "path": "secret_request"},
+                  {"method": "POST", "path": "menu-items", "body": {"title": "..."}}],
+     "concurrent": true}
+authenticates once, then calls the views of LittlelemonAPI/urls.py directly (in the same process) with the
+already authenticated user. Every view still runs its own permissions and throttles.
+With "concurrent": true the reads (GET/HEAD) between two writes run at the same time in a thread pool,
+the writes always run one after the other in the given order. """
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404
+from django.test.client import RequestFactory
+from django.urls import resolve, URLPattern
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+METHODS = (*READ_METHODS, 'POST', 'PUT', 'PATCH', 'DELETE')
+# copied from the batch request, the throttles use the client address and the links use the host
+INHERITED_META = ('REMOTE_ADDR', 'HTTP_X_FORWARDED_FOR', 'HTTP_HOST', 'SERVER_NAME', 'SERVER_PORT',
+                  'HTTP_ACCEPT_LANGUAGE', 'HTTP_USER_AGENT')
+# the sub-requests use the authentication of the batch request
+FORBIDDEN_HEADERS = ('authorization', 'cookie')
+
+
+class BatchError(Exception):
+    """ The batch request itself is not valid (400) """
+
+
+def _allowed_views():
+    # only the views of our api, not the batch view itself (no nested batches) or the debug toolbar
+    from LittlelemonAPI import urls
+    return {pattern.callback for pattern in urls.urlpatterns
+            if isinstance(pattern, URLPattern) and pattern.name != 'batch'}
+
+
+def parse_batch(data):
+    """
+    Check the body of the batch request
+    :return: the list of sub-requests and the concurrent flag
+    """
+    sub_requests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(sub_requests, list) or not sub_requests:
+        raise BatchError('requests should be a non-empty list')
+    if len(sub_requests) > settings.BATCH_MAX_REQUESTS:
+        raise BatchError(f'a batch can have at most {settings.BATCH_MAX_REQUESTS} requests')
+    for sub_request in sub_requests:
+        if not isinstance(sub_request, dict) or not isinstance(sub_request.get('path'), str):
+            raise BatchError('every request needs a path')
+        method = sub_request.get('method', 'GET')
+        if not isinstance(method, str) or method.upper() not in METHODS:
+            raise BatchError(f'method should be one of {", ".join(METHODS)}')
+        if not isinstance(sub_request.get('headers', {}), dict):
+            raise BatchError('headers should be an object')
+    concurrent = data.get('concurrent', False)
+    # bool() would turn "false" into True
+    if not isinstance(concurrent, bool):
+        raise BatchError('concurrent should be true or false')
+    return sub_requests, concurrent
+
+
+def run_batch(request, sub_requests, concurrent=False):
+    """
+    :param request: the authenticated DRF request of the batch
+    :param sub_requests: the list returned by parse_batch()
+    :param concurrent: run the reads in parallel
+    :return: one response dictionary for each sub-request, in the same order
+    """
+    allowed_views = _allowed_views()
+    results = [None] * len(sub_requests)
+    if not concurrent:
+        for index, sub_request in enumerate(sub_requests):
+            results[index] = _dispatch(request, sub_request, allowed_views)
+        return results
+
+    with ThreadPoolExecutor(max_workers=settings.BATCH_MAX_WORKERS) as executor:
+        reads = []
+        for index, sub_request in enumerate(sub_requests):
+            if sub_request.get('method', 'GET').upper() in READ_METHODS:
+                reads.append((index, executor.submit(_dispatch_in_thread, request, sub_request, allowed_views)))
+                continue
+            # a write waits for the reads before it, and the reads after it wait for the write
+            for read_index, future in reads:
+                results[read_index] = future.result()
+            reads = []
+            results[index] = _dispatch(request, sub_request, allowed_views)
+        for read_index, future in reads:
+            results[read_index] = future.result()
+    return results
+
+
+def _dispatch_in_thread(request, sub_request, allowed_views):
+    try:
+        return _dispatch(request, sub_request, allowed_views)
+    finally:
+        # every thread opens its own database connection
+        connections.close_all()
+
+
+def _dispatch(request, sub_request, allowed_views):
+    method = sub_request.get('method', 'GET').upper()
+    path = sub_request['path']
+    if not path.startswith('/'):
+        path = f'/api/{path}'
+    try:
+        match = resolve(urlsplit(path).path)
+    except Http404:
+        match = None
+    if match is None or match.func not in allowed_views:
+        return {'status': 404, 'body': {'detail': 'Not found.'}}
+
+    try:
+        response = match.func(_build_sub_request(request, method, path, sub_request), *match.args, **match.kwargs)
+        return _to_result(response)
+    except Exception:
+        logger.exception('Batch sub-request %s %s failed', method, path)
+        return {'status': 500, 'body': {'detail': 'Internal server error.'}}
+
+
+def _build_sub_request(request, method, path, sub_request):
+    django_request = request._request
+    headers = {
+        f"HTTP_{name.upper().replace('-', '_')}": value
+        for name, value in sub_request.get('headers', {}).items() if name.lower() not in FORBIDDEN_HEADERS
+    }
+    # like a client without an Accept header, every view answers with its first renderer
+    # (JSON for most of them, CSV/YAML/HTML for the views that only have that renderer)
+    headers.setdefault('HTTP_ACCEPT', '*/*')
+    headers.update({key: django_request.META[key] for key in INHERITED_META if key in django_request.META})
+    body = sub_request.get('body')
+    sub = RequestFactory().generic(method, path, data=json.dumps(body) if body is not None else '',
+                                   content_type='application/json', secure=django_request.is_secure(), **headers)
+    # DRF uses this user instead of running the authentication classes again
+    sub._force_auth_user = request.user
+    sub._force_auth_token = request.auth
+    sub.user = request.user
+    if hasattr(django_request, 'session'):
+        sub.session = django_request.session
+    return sub
+
+
+def _to_result(response):
+    result = {'status': response.status_code}
+    if isinstance(response, Response) and isinstance(response.accepted_renderer, JSONRenderer):
+        # no need to render it to JSON and parse it again, the batch response is rendered as JSON anyway
+        result['body'] = response.data
+        return result
+    if hasattr(response, 'render'):
+        response.render()
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    result['headers'] = {'Content-Type': response.get('Content-Type')}
+    result['body'] = content.decode(response.charset, errors='replace')
+    return result
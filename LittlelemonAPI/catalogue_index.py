@@ -0,0 +1,277 @@
+""" An in-memory copy of the menu, to filter/search/order it without a database query.
+
+The whole catalogue fits in memory, so every worker process can keep a compact copy of it:
+    - one small record (with __slots__) for each item, the price is kept in cents (an int),
+    - the items sorted by price and by inventory, a price range (to_price) is a bisect on the sorted prices,
+    - the items of each category (by category title, like the filter),
+    - the words of the titles -> items, a substring search only checks the items that have a word
+      containing each word of the search, instead of all the items.
+The category and the search are case-insensitive, like the database path (iexact / icontains),
+but a case-insensitive MySQL collation also ignores the accents (e = é) and the index doesn't.
+Before each query we compare the index with the menu version (menu_versions.py),
+when it changed we reload only the changed rows from the change log, or everything if we can't know.
+It's enabled with MENU_CATALOGUE_INDEX = True. """
+import re
+import threading
+from operator import attrgetter
+from bisect import bisect_right, insort
+from decimal import Decimal, InvalidOperation, ROUND_FLOOR
+
+from LittlelemonAPI import menu_versions
+from LittlelemonAPI.facets import price_ranges
+from LittlelemonAPI.models import MenuItem, Category
+
+WORD = re.compile(r'\w+')
+TAX = Decimal(1.1)
+# ordering by title is left to the database, python and the database collation don't sort strings the same way
+ORDERING_FIELDS = {
+    'id': attrgetter('id'),
+    'price': attrgetter('price_cents'),
+    'inventory': attrgetter('inventory'),
+}
+
+
+class UnsupportedQuery(Exception):
+    """ The index can't answer this query (e.g. ordering by another field), use the database """
+
+
+class IndexedItem:
+    __slots__ = ('id', 'title', 'price_cents', 'inventory', 'category_id')
+
+    def __init__(self, id, title, price, inventory, category_id):
+        self.id = id
+        self.title = title
+        self.price_cents = int(price * 100)
+        self.inventory = inventory
+        self.category_id = category_id
+
+    def price_key(self):
+        return self.price_cents, self.id
+
+    def inventory_key(self):
+        return self.inventory, self.id
+
+
+def _words(title):
+    return set(WORD.findall(title.lower()))
+
+
+class CatalogueIndex:
+
+    def __init__(self):
+        self.version = None
+        self.items = {}
+        self.categories = {}  # id -> (slug, title)
+        self.category_items = {}  # category id -> set of item ids
+        self.by_price = []
+        self.by_inventory = []
+        self.words = {}  # word -> set of item ids
+        self.lock = threading.Lock()
+
+    # ---- loading
+
+    def refresh(self):
+        """ Bring the index up to date with the menu version """
+        version = menu_versions.get_menu_version()
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            changes = None if self.version is None else menu_versions.get_menu_changes(self.version, version)
+            if changes is None:
+                self.load_all()
+            else:
+                self.apply_changes(changes)
+            self.version = version
+
+    def load_all(self):
+        self.categories = {
+            pk: (slug, title) for pk, slug, title in Category.objects.values_list('id', 'slug', 'title')
+        }
+        self.items = {
+            row[0]: IndexedItem(*row)
+            for row in MenuItem.objects.values_list('id', 'title', 'price', 'inventory', 'category_id').iterator()
+        }
+        self.by_price = sorted(self.items.values(), key=IndexedItem.price_key)
+        self.by_inventory = sorted(self.items.values(), key=IndexedItem.inventory_key)
+        self.category_items = {pk: set() for pk in self.categories}
+        self.words = {}
+        for item in self.items.values():
+            self._add_to_maps(item)
+
+    def apply_changes(self, changes):
+        item_ids = {pk for kind, pk in changes if kind == 'item'}
+        category_ids = {pk for kind, pk in changes if kind == 'category'}
+        if category_ids:
+            found = {pk: (slug, title) for pk, slug, title in
+                     Category.objects.filter(pk__in=category_ids).values_list('id', 'slug', 'title')}
+            for pk in category_ids:
+                if pk in found:
+                    self.categories[pk] = found[pk]
+                    self.category_items.setdefault(pk, set())
+                else:
+                    # a category can only be deleted without items (on_delete=PROTECT)
+                    self.categories.pop(pk, None)
+                    self.category_items.pop(pk, None)
+        if item_ids:
+            for item_id in item_ids:
+                self._remove(item_id)
+            for row in MenuItem.objects.filter(pk__in=item_ids).values_list(
+                    'id', 'title', 'price', 'inventory', 'category_id'):
+                self._add(IndexedItem(*row))
+
+    def _add(self, item):
+        self.items[item.id] = item
+        insort(self.by_price, item, key=IndexedItem.price_key)
+        insort(self.by_inventory, item, key=IndexedItem.inventory_key)
+        self._add_to_maps(item)
+
+    def _add_to_maps(self, item):
+        self.category_items.setdefault(item.category_id, set()).add(item.id)
+        for word in _words(item.title):
+            self.words.setdefault(word, set()).add(item.id)
+
+    def _remove(self, item_id):
+        item = self.items.pop(item_id, None)
+        if item is None:
+            return
+        for ordered, key in ((self.by_price, IndexedItem.price_key), (self.by_inventory, IndexedItem.inventory_key)):
+            position = bisect_right(ordered, key(item), key=key) - 1
+            del ordered[position]
+        self.category_items.get(item.category_id, set()).discard(item_id)
+        for word in _words(item.title):
+            ids = self.words.get(word)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del self.words[word]
+
+    # ---- queries
+
+    def filter(self, category=None, to_price=None, search=None, ordering=None):
+        """
+        The same filters as menu_items_filter_data
+        :param category: the category title (case-insensitive)
+        :param to_price: the maximum price (included)
+        :param search: a part of the title (case-insensitive)
+        :param ordering: the fields separated by commas, with - for descending order (e.g. "-price,inventory")
+        :return: the list of items
+        """
+        sort_keys = self._sort_keys(ordering) or [('id', False)]
+        # the field the items are already sorted by (then by id)
+        sorted_by = None
+        with self.lock:
+            candidates = None
+            if category:
+                category = category.lower()
+                category_ids = [pk for pk, (_, title) in self.categories.items() if title.lower() == category]
+                candidates = set().union(*(self.category_items[pk] for pk in category_ids))
+            if search:
+                candidates = self._search(search, candidates)
+
+            if to_price:
+                try:
+                    max_cents = int((Decimal(to_price) * 100).to_integral_value(rounding=ROUND_FLOOR))
+                except (InvalidOperation, ValueError, OverflowError):
+                    raise UnsupportedQuery()
+                # the items sorted by price up to the maximum price
+                end = bisect_right(self.by_price, (max_cents, float('inf')), key=IndexedItem.price_key)
+                items = self.by_price[:end]
+                sorted_by = 'price'
+                if candidates is not None:
+                    items = [item for item in items if item.id in candidates]
+            elif sort_keys[0][0] in ('price', 'inventory') and candidates is None:
+                sorted_by = sort_keys[0][0]
+                items = list(self.by_price if sorted_by == 'price' else self.by_inventory)
+            elif candidates is None:
+                items = list(self.items.values())
+            else:
+                items = [self.items[pk] for pk in candidates]
+
+        if len(sort_keys) == 1 and sort_keys[0][0] == sorted_by:
+            if sort_keys[0][1]:
+                items.reverse()
+            return items
+        # a stable sort on each field, from the last one to the first one
+        for field, descending in reversed(sort_keys):
+            items.sort(key=ORDERING_FIELDS[field], reverse=descending)
+        return items
+
+    def _sort_keys(self, ordering):
+        sort_keys = []
+        for field in (ordering or '').split(','):
+            field = field.strip()
+            if not field:
+                continue
+            descending = field.startswith('-')
+            field = field.lstrip('-')
+            if field == 'pk':
+                field = 'id'
+            if field not in ORDERING_FIELDS:
+                raise UnsupportedQuery()
+            sort_keys.append((field, descending))
+        return sort_keys
+
+    def _search(self, search, candidates):
+        search = search.lower()
+        for part in WORD.findall(search):
+            # every word of the search is inside a word of the title
+            matching = set().union(*(ids for word, ids in self.words.items() if part in word))
+            candidates = matching if candidates is None else candidates & matching
+        pool = candidates if candidates is not None else self.items.keys()
+        return {pk for pk in pool if search in self.items[pk].title.lower()}
+
+    # ---- output
+
+    def serialize(self, items):
+        """ The same output as MenuItemSerializerAutomatic """
+        data = []
+        for item in items:
+            slug, category_title = self.categories.get(item.category_id, ('', ''))
+            # 650 -> Decimal('6.50'), with the 2 decimal places of the database
+            price = Decimal(item.price_cents).scaleb(-2)
+            data.append({
+                'id': item.id,
+                'title': item.title,
+                'price': str(price),
+                'stock': item.inventory,
+                'price_after_tax': price * TAX,
+                'category_str': f'{category_title} || {len(self.category_items.get(item.category_id, ()))}',
+                'category': {'id': item.category_id, 'slug': slug, 'title': category_title},
+            })
+        return data
+
+    def facets(self, items):
+        """ The same output as facets.compute_facets() """
+        ranges = price_ranges()
+        counts_by_category = {}
+        price_counts = [0] * len(ranges)
+        for item in items:
+            counts_by_category[item.category_id] = counts_by_category.get(item.category_id, 0) + 1
+            for index, (_, _, high) in enumerate(ranges):
+                if high is None or item.price_cents < high * 100:
+                    price_counts[index] += 1
+                    break
+        categories = [
+            {'id': pk, 'slug': self.categories.get(pk, ('', ''))[0], 'title': self.categories.get(pk, ('', ''))[1],
+             'count': count}
+            for pk, count in counts_by_category.items()
+        ]
+        return {
+            'total': len(items),
+            'categories': sorted(categories, key=lambda category: (-category['count'], category['title'])),
+            'price_ranges': [
+                {'range': label, 'min': low, 'max': high, 'count': count}
+                for (label, low, high), count in zip(ranges, price_counts)
+            ],
+        }
+
+
+_index = CatalogueIndex()
+
+
+def get_catalogue_index():
+    """ The index of this process, up to date with the menu version """
+    _index.refresh()
+    return _index
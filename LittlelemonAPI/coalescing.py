@@ -0,0 +1,107 @@
+""" Single-flight (request coalescing) for cached data that is expensive to build.
+
+When a cache entry expires, or the menu changes, all the requests that arrive at the same time
+would miss the cache together and run the same query (thundering herd).
+With single_flight() only one of them rebuilds the entry:
+    - threads of the same process wait for the thread that is already building the key,
+    - other processes see a lock in the shared cache and wait for the entry to appear,
+    - while somebody is rebuilding, the old (stale) value is returned if we still have it. """
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+
+class _Flight:
+    """ One rebuild that is running in this process, the other threads wait on the event """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(key, build, version=None, timeout=60, stale_timeout=300, lock_timeout=30, wait=5.0,
+                  poll_interval=0.05):
+    """
+    Get the value of key from the cache, or build it, making sure it is built only once at a time
+    :param key: the cache key
+    :param build: a function without arguments that returns the value
+    :param version: the value is stale if it was built for another version (e.g. the menu version)
+    :param timeout: how long (in seconds) the value is fresh
+    :param stale_timeout: how long (in seconds) after that the stale value can still be returned
+    :param lock_timeout: how long the lock of the shared cache is kept if the builder process dies
+    :param wait: how long (in seconds) to wait for another builder before building the value ourselves
+    :param poll_interval: how often we check the shared cache while another process is building
+    :return: the value
+    """
+    entry = cache.get(key)
+    if _is_fresh(entry, version):
+        return entry['value']
+
+    # 1- only one thread of this process goes further, the others wait for its result
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if entry is not None:
+            # stale-while-revalidate
+            return entry['value']
+        if flight.event.wait(wait):
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        # the builder is too slow, we don't keep the request waiting forever
+        return build()
+
+    try:
+        flight.value = _build_once_across_processes(key, build, entry, version, timeout, stale_timeout,
+                                                    lock_timeout, wait, poll_interval)
+        return flight.value
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        flight.event.set()
+        with _flights_lock:
+            _flights.pop(key, None)
+
+
+def _is_fresh(entry, version):
+    return entry is not None and entry['version'] == version and entry['fresh_until'] > time.time()
+
+
+def _build_once_across_processes(key, build, stale_entry, version, timeout, stale_timeout, lock_timeout, wait,
+                                 poll_interval):
+    # 2- only one process goes further, the lock is a key in the shared cache
+    # cache.add() only sets the key if it doesn't exist, so only one process can get it
+    lock_key = f'{key}:lock'
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, timeout=lock_timeout):
+        try:
+            value = build()
+            cache.set(key, {'value': value, 'version': version, 'fresh_until': time.time() + timeout},
+                      timeout=timeout + stale_timeout)
+            return value
+        finally:
+            # don't delete the lock of another process if ours has expired in the meantime
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    if stale_entry is not None:
+        return stale_entry['value']
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        entry = cache.get(key)
+        if _is_fresh(entry, version):
+            return entry['value']
+    return build()
@@ -0,0 +1,251 @@
+""" Background export jobs for the whole menu (CSV / YAML).
+
+A full export can take seconds on a big catalogue, so instead of rendering it in the request we:
+    1- write a job file (<EXPORT_ROOT>/<job_id>.json) and submit the job to a local process pool,
+    2- the worker process serializes the menu in chunks, writes its progress in the job file
+       and appends every chunk to the result next to it (<EXPORT_ROOT>/<job_id>.csv),
+    3- the client polls the job and downloads the file when it's done.
+The job files are on disk, so every web worker can answer the polling requests, not only the one that
+submitted the job. Old jobs and results are deleted after EXPORT_RESULT_TTL seconds. """
+import csv
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+
+EXPORT_FORMATS = {
+    # format -> (file extension, content type)
+    'csv': ('csv', 'text/csv'),
+    'yaml': ('yaml', 'application/yaml'),
+}
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class TooManyExportsError(Exception):
+    """ Raised when the pool already has EXPORT_MAX_PENDING_JOBS jobs waiting or running """
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn instead of fork, a forked worker would share the database connections of the web worker
+            _executor = ProcessPoolExecutor(max_workers=settings.EXPORT_MAX_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker)
+        return _executor
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _export_root():
+    root = Path(settings.EXPORT_ROOT)
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def _job_path(job_id):
+    return _export_root() / f'{job_id}.json'
+
+
+def _write_job(job):
+    # write to a temporary file and rename it, so a polling request never reads half a file
+    path = _job_path(job['id'])
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(job))
+    os.replace(tmp_path, path)
+
+
+def get_job(job_id):
+    """
+    :param job_id: the id returned by submit_export()
+    :return: the job dictionary, or None if the job doesn't exist (or has expired)
+    """
+    try:
+        uuid.UUID(hex=job_id)
+        return json.loads(_job_path(job_id).read_text())
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def get_result_path(job):
+    extension, _ = EXPORT_FORMATS[job['format']]
+    return _export_root() / f"{job['id']}.{extension}"
+
+
+def _modified_at(path):
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return time.time()
+
+
+def purge_expired_exports():
+    """ Delete the jobs (and their files) that are older than EXPORT_RESULT_TTL.
+    A queued/running job is kept as long as its worker updates the job file: it's deleted only when the file
+    wasn't written for EXPORT_RESULT_TTL seconds, the job was lost (e.g. the server restarted) """
+    expired_before = time.time() - settings.EXPORT_RESULT_TTL
+    root = _export_root()
+    for path in root.glob('*.json'):
+        job = get_job(path.stem)
+        if job is None:
+            continue
+        if job['status'] in (QUEUED, RUNNING):
+            expired = _modified_at(path) < expired_before
+        else:
+            expired = job['created_at'] < expired_before
+        if expired:
+            result_path = get_result_path(job)
+            result_path.unlink(missing_ok=True)
+            result_path.with_suffix('.part').unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+    # the files without a job: the unfinished results (.part) and the job files (.tmp) of a worker that died,
+    # the results of a job file deleted by hand
+    for path in root.iterdir():
+        if path.suffix != '.json' and not _job_path(path.stem).exists() and _modified_at(path) < expired_before:
+            path.unlink(missing_ok=True)
+
+
+def submit_export(export_format):
+    """
+    Create an export job and run it in the background
+    :param export_format: one of EXPORT_FORMATS
+    :return: the job dictionary
+    """
+    global _pending
+    with _executor_lock:
+        if _pending >= settings.EXPORT_MAX_PENDING_JOBS:
+            raise TooManyExportsError()
+        _pending += 1
+
+    purge_expired_exports()
+    job = {
+        'id': uuid.uuid4().hex,
+        'format': export_format,
+        'status': QUEUED,
+        'processed': 0,
+        'total': None,
+        'created_at': time.time(),
+        'finished_at': None,
+        'error': None,
+    }
+    _write_job(job)
+    try:
+        future = _get_executor().submit(run_export, job['id'])
+    except Exception:
+        _job_finished(job['id'], None)
+        raise
+    future.add_done_callback(lambda f: _job_finished(job['id'], f))
+    return job
+
+
+def _job_finished(job_id, future):
+    global _pending
+    with _executor_lock:
+        _pending -= 1
+    # the worker process died (or the job was never started), the worker couldn't mark the job itself
+    if future is None or future.exception() is not None:
+        job = get_job(job_id)
+        if job is not None and job['status'] not in (DONE, FAILED):
+            job.update(status=FAILED, finished_at=time.time(), error='The export worker stopped unexpectedly')
+            _write_job(job)
+
+
+def run_export(job_id):
+    """ Runs in a worker process of the pool """
+    from LittlelemonAPI.models import MenuItem, category_counts, preload_category_counts
+    from LittlelemonAPI.serializers import MenuItemSerializerAutomatic
+
+    job = get_job(job_id)
+    if job is None:
+        # the job was purged before a worker could start it
+        return
+    result_path = get_result_path(job)
+    tmp_path = result_path.with_suffix('.part')
+    try:
+        items = MenuItem.objects.select_related('category').order_by('pk')
+        job.update(status=RUNNING, total=items.count())
+        _write_job(job)
+        # the category string shows the number of items of the category,
+        # we count them once instead of one count() query for each item
+        counts = category_counts()
+
+        writer = _CSVChunkWriter() if job['format'] == 'csv' else _YAMLChunkWriter()
+        last_pk = 0
+        with open(tmp_path, 'wb') as file:
+            while True:
+                # keyset pagination, every chunk is a small indexed query
+                chunk = list(items.filter(pk__gt=last_pk)[:settings.EXPORT_CHUNK_SIZE])
+                if not chunk:
+                    break
+                rows = MenuItemSerializerAutomatic(preload_category_counts(chunk, counts), many=True).data
+                # every chunk is written to the file, we never keep the whole menu in memory
+                file.write(writer.render(list(rows)))
+                last_pk = chunk[-1].pk
+                job['processed'] += len(chunk)
+                _write_job(job)
+            file.write(writer.end())
+        os.replace(tmp_path, result_path)
+        job.update(status=DONE, finished_at=time.time())
+    except Exception as error:
+        tmp_path.unlink(missing_ok=True)
+        job.update(status=FAILED, finished_at=time.time(), error=str(error))
+    _write_job(job)
+
+
+class _CSVChunkWriter:
+    """ The output of CSVRenderer, one chunk at a time: the header comes from the first chunk
+    (all the rows have the same columns) and is written only once """
+
+    def __init__(self):
+        from rest_framework_csv.renderers import CSVRenderer
+        self.renderer = CSVRenderer()
+        self.started = False
+
+    def render(self, rows):
+        table = self.renderer.tablize(rows)
+        if self.started:
+            table = table[1:]
+        else:
+            self.renderer.headers = table[0]
+            self.started = True
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(table)
+        return buffer.getvalue().encode(self.renderer.charset)
+
+    def end(self):
+        return b''
+
+
+class _YAMLChunkWriter:
+    """ The output of YAMLRenderer, one chunk at a time: the items of a block sequence can be written one after
+    the other, the whole file is still one list """
+
+    def __init__(self):
+        from rest_framework_yaml.renderers import YAMLRenderer
+        self.renderer = YAMLRenderer()
+        self.started = False
+
+    def render(self, rows):
+        self.started = True
+        return self.renderer.render(rows)
+
+    def end(self):
+        # an empty menu
+        return b'' if self.started else self.renderer.render([])
@@ -0,0 +1,86 @@
+""" Facet counts (items per category and per price range) for the menu filter.
+
+All the counts come from one GROUP BY query on (category, price range), instead of one count() query per facet,
+so it's still one query with hundreds of categories. The total is the sum of the groups,
+so the paginator doesn't need its own COUNT(*) either.
+The result is cached by the filter parameters and the menu version (see menu_versions.py). """
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, When, Value, Count, IntegerField
+
+from LittlelemonAPI.menu_versions import get_menu_version
+
+
+def price_ranges():
+    """
+    :return: a list of (label, min price, max price) built from the MENU_PRICE_FACET_EDGES setting,
+             min is included and max is excluded, None means no limit
+    """
+    edges = [None, *settings.MENU_PRICE_FACET_EDGES, None]
+    ranges = []
+    for low, high in zip(edges, edges[1:]):
+        if low is None:
+            label = f'<{high}'
+        elif high is None:
+            label = f'>={low}'
+        else:
+            label = f'{low}-{high}'
+        ranges.append((label, low, high))
+    return ranges
+
+
+def compute_facets(items):
+    """
+    :param items: the filtered MenuItem queryset (before ordering and pagination)
+    :return: a dictionary with the total, the category counts and the price range counts
+    """
+    ranges = price_ranges()
+    price_range = Case(
+        *[When(price__lt=high, then=Value(index)) for index, (_, _, high) in enumerate(ranges[:-1])],
+        default=Value(len(ranges) - 1),
+        output_field=IntegerField(),
+    )
+    # order_by() removes any ordering, it would be added to the GROUP BY
+    groups = (items.order_by()
+              .annotate(price_range=price_range)
+              .values('category_id', 'category__slug', 'category__title', 'price_range')
+              .annotate(count=Count('id')))
+
+    categories = {}
+    price_counts = [0] * len(ranges)
+    for group in groups:
+        category = categories.setdefault(group['category_id'], {
+            'id': group['category_id'],
+            'slug': group['category__slug'],
+            'title': group['category__title'],
+            'count': 0,
+        })
+        category['count'] += group['count']
+        price_counts[group['price_range']] += group['count']
+
+    return {
+        'total': sum(price_counts),
+        'categories': sorted(categories.values(), key=lambda category: (-category['count'], category['title'])),
+        'price_ranges': [
+            {'range': label, 'min': low, 'max': high, 'count': count}
+            for (label, low, high), count in zip(ranges, price_counts)
+        ],
+    }
+
+
+def get_facets(items, filters):
+    """
+    Cached compute_facets()
+    :param items: the filtered MenuItem queryset
+    :param filters: the filter parameters used to build the queryset (the cache key)
+    """
+    signature = hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()
+    key = f'menu-facets:{get_menu_version()}:{signature}'
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(items)
+        cache.set(key, facets, timeout=settings.MENU_CACHE_TIMEOUT)
+    return facets
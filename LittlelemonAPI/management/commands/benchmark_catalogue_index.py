@@ -0,0 +1,111 @@
+""" Compare the menu filter on the database (ORM) and on the in-memory catalogue index,
+and check the memory used by the index for each item.
+
+    python manage.py benchmark_catalogue_index --size 10000
+
+The menu items are created inside a transaction that is rolled back at the end. """
+import statistics
+import time
+import tracemalloc
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import transaction
+
+from LittlelemonAPI.catalogue_index import CatalogueIndex
+from LittlelemonAPI.models import MenuItem, Category
+from LittlelemonAPI.serializers import MenuItemSerializerAutomatic
+
+WORDS = ['lemon', 'mint', 'iced', 'tea', 'cake', 'orange', 'ginger', 'sparkling', 'classic', 'honey']
+PER_PAGE = 10
+
+
+class Command(BaseCommand):
+    help = 'Benchmark menu_items_filter_data on the ORM and on the in-memory catalogue index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=10000, help='number of menu items')
+        parser.add_argument('--categories', type=int, default=50, help='number of categories')
+        parser.add_argument('--repeat', type=int, default=20, help='number of timed runs for each query')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.benchmark(options['size'], options['categories'], options['repeat'])
+            # we never keep the generated items
+            transaction.set_rollback(True)
+
+    def benchmark(self, size, category_count, repeat):
+        run = uuid.uuid4().hex[:8]
+        categories = Category.objects.bulk_create(
+            Category(slug=f'benchmark-{run}-{i}', title=f'Benchmark {run} {i}') for i in range(category_count)
+        )
+        MenuItem.objects.bulk_create(
+            MenuItem(title=f'{WORDS[i % 10]} {WORDS[i // 10 % 10]} {run} {i}', price=5 + i % 500 + (i % 100) / 100,
+                     inventory=i % 200, category=categories[i % category_count])
+            for i in range(size)
+        )
+
+        index = CatalogueIndex()
+        tracemalloc.start()
+        start = time.perf_counter()
+        index.load_all()
+        load_time = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        total_items = len(index.items)
+        bytes_per_item = memory / total_items
+        budget = settings.MENU_CATALOGUE_INDEX_MAX_BYTES_PER_ITEM
+
+        self.stdout.write(f'{total_items} items indexed in {load_time * 1000:.0f} ms, '
+                          f'{memory / 1024 / 1024:.1f} MB ({bytes_per_item:.0f} bytes/item, budget {budget})')
+
+        queries = {
+            'category': {'category': categories[0].title},
+            'to_price': {'to_price': '50'},
+            'search': {'search': 'lemon mint'},
+            'ordering': {'ordering': '-price,inventory'},
+            'combined': {'category': categories[1].title, 'to_price': '300', 'search': 'ginger',
+                         'ordering': 'inventory'},
+        }
+        self.stdout.write(f"{'query':<10}{'orm (ms)':>12}{'index (ms)':>12}")
+        for name, params in queries.items():
+            orm = self.timed(lambda: self.orm_page(params), repeat)
+            in_memory = self.timed(lambda: self.index_page(index, params), repeat)
+            self.stdout.write(f'{name:<10}{orm * 1000:>12.2f}{in_memory * 1000:>12.3f}')
+
+        if bytes_per_item > budget:
+            self.stdout.write(self.style.ERROR(f'The index uses more than {budget} bytes/item'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'The index is within the budget of {budget} bytes/item'))
+
+    @staticmethod
+    def orm_page(params):
+        # the same queries as menu_items_filter_data
+        items = MenuItem.objects.select_related('category').all()
+        if params.get('category'):
+            items = items.filter(category__title__iexact=params['category'])
+        if params.get('to_price'):
+            items = items.filter(price__lte=params['to_price'])
+        if params.get('search'):
+            items = items.filter(title__icontains=params['search'])
+        if params.get('ordering'):
+            items = items.order_by(*params['ordering'].split(','))
+        page = Paginator(items, per_page=PER_PAGE).page(1)
+        return MenuItemSerializerAutomatic(page, many=True).data
+
+    @staticmethod
+    def index_page(index, params):
+        items = index.filter(**params)
+        page = Paginator(items, per_page=PER_PAGE).page(1)
+        return index.serialize(page)
+
+    @staticmethod
+    def timed(function, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings)
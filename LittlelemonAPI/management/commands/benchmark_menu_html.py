@@ -0,0 +1,97 @@
+""" Measure how long the menu-items.html page takes, split into serialization and rendering,
+with the old serializer (one count() query per row for the category string) and with the cached rows (menu_rows.py).
+
+    python manage.py benchmark_menu_html --sizes 1000 10000
+
+The menu items are created inside a transaction that is rolled back at the end,
+so it can be run against a development database without leaving data behind. """
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection
+from django.template.loader import render_to_string
+
+from LittlelemonAPI.menu_rows import get_serialized_rows
+from LittlelemonAPI.menu_versions import bump_item_version
+from LittlelemonAPI.models import MenuItem, Category
+from LittlelemonAPI.serializers import MenuItemSerializerAutomatic
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the queries run inside the block, the query log of the connection (CaptureQueriesContext)
+    keeps only the last 9000 queries
+    :return: a list with one number, updated by every query
+    """
+    count = [0]
+
+    def counter(execute, sql, params, many, context):
+        count[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counter):
+        yield count
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the menu-items.html page with and without the cached serialized rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000],
+                            help='number of menu items to render')
+        parser.add_argument('--repeat', type=int, default=5, help='number of timed runs for each case')
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            with transaction.atomic():
+                self.benchmark(size, options['repeat'])
+                # we never keep the generated items
+                transaction.set_rollback(True)
+
+    def benchmark(self, size, repeat):
+        run = uuid.uuid4().hex[:8]
+        category = Category.objects.create(slug=f'benchmark-{run}', title=f'Benchmark {run}')
+        MenuItem.objects.bulk_create(
+            MenuItem(title=f'Benchmark item {run} {i}', price=5 + i % 90, inventory=i % 50, category=category)
+            for i in range(size)
+        )
+
+        # this is how the page was serialized before
+        with count_queries() as queries:
+            old_serialize = self.timed(
+                lambda: MenuItemSerializerAutomatic(MenuItem.objects.select_related('category'), many=True).data, 1)
+        old_queries = queries[0]
+
+        # the first call fills the row cache
+        with count_queries() as queries:
+            cold = self.timed(get_serialized_rows, 1)
+        cold_queries = queries[0]
+        with count_queries() as queries:
+            warm = self.timed(get_serialized_rows, repeat)
+        warm_queries = queries[0] // repeat
+
+        # one item changed, only its row is serialized again
+        bump_item_version(MenuItem.objects.filter(category=category).values_list('id', flat=True).first())
+        one_changed = self.timed(get_serialized_rows, 1)
+
+        data = get_serialized_rows()
+        render = self.timed(lambda: render_to_string('menu-items.html', {'data': data}), repeat)
+
+        self.stdout.write(f'{len(data)} items (render {render * 1000:.1f} ms)')
+        self.stdout.write(f'    serializer, no cache : {old_serialize * 1000:8.1f} ms {old_queries:6} queries')
+        self.stdout.write(f'    cold row cache       : {cold * 1000:8.1f} ms {cold_queries:6} queries')
+        self.stdout.write(f'    warm row cache       : {warm * 1000:8.1f} ms {warm_queries:6} queries')
+        self.stdout.write(f'    one row changed      : {one_changed * 1000:8.1f} ms')
+
+    @staticmethod
+    def timed(function, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings)
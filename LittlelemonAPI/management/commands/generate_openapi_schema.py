@@ -0,0 +1,20 @@
+""" Generate the OpenAPI schema once (on deploy), the schema views serve this file from memory.
+
+    python manage.py generate_openapi_schema """
+import hashlib
+
+from django.core.management.base import BaseCommand
+
+from LittlelemonAPI.schema import write_schema
+
+
+class Command(BaseCommand):
+    help = 'Generate the OpenAPI schema served by menu-OpenAPIRenderer and menu-JsonOpenAPIRenderer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='where to write the schema, by default settings.OPENAPI_SCHEMA_PATH')
+
+    def handle(self, *args, **options):
+        path = write_schema(options['path'])
+        content_hash = hashlib.sha256(path.read_bytes()).hexdigest()
+        self.stdout.write(self.style.SUCCESS(f'Schema written to {path} (sha256 {content_hash})'))
@@ -0,0 +1,258 @@
+""" Import a big catalogue of menu items from a CSV or NDJSON file.
+
+    python manage.py import_menu items.csv
+    python manage.py import_menu items.ndjson --update --workers 4
+
+Every row needs a title, a price, an inventory (or stock) and the slug of its category:
+    title,price,inventory,category
+    Lemonade,5.50,100,drinks
+
+The rows are read as a stream and validated in chunks by a pool of worker processes (bleach is the slow part),
+the main process resolves the categories with one query, skips (or with --update, updates) the titles that already
+exist and writes every chunk with bulk_create in its own transaction.
+After each chunk the number of imported rows is saved in a checkpoint file, if the import fails
+running the same command again continues after the last saved chunk.
+
+bulk_create/bulk_update don't send the signals, so the command bumps the menu versions itself (menu_versions.py).
+The versions are in the default cache: the web workers only see them when the cache is shared (e.g. Redis or
+Memcached). With the local-memory cache of the development settings the command only bumps its own copy,
+the running server keeps serving the cached menu until it expires or the server restarts. """
+import csv
+import json
+import multiprocessing
+import re
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from pathlib import Path
+
+import bleach
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from rest_framework import serializers
+
+from LittlelemonAPI import menu_versions
+from LittlelemonAPI.models import MenuItem, Category
+
+TITLE_MAX_LENGTH = MenuItem._meta.get_field('title').max_length
+# the same rules as MenuItemSerializerAutomatic.validate() and the price column of the model
+MIN_PRICE = Decimal('5')
+MAX_PRICE = Decimal('999.99')
+# the stock field of MenuItemSerializerAutomatic, and the largest value of the inventory column
+INVENTORY_FIELD = serializers.IntegerField()
+MAX_INVENTORY = 2 ** 31 - 1
+# bleach only changes a text that has html characters or control characters,
+# most titles don't have any so we don't need to pay for bleach.clean() on them
+NEEDS_CLEANING = re.compile(r'[<>&\x00-\x08\x0b-\x1f\x7f-\x9f]')
+UPDATE_BATCH_SIZE = 500
+
+
+def read_rows(path, file_format):
+    """
+    :return: a generator of (line number, row dictionary)
+    """
+    with open(path, newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            # the header is line 1
+            for line_number, row in enumerate(csv.DictReader(file), start=2):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(file, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError:
+                        yield line_number, None
+
+
+def validate_chunk(chunk):
+    """
+    Runs in a worker process, it must not use the database
+    :param chunk: a list of (line number, row dictionary)
+    :return: the number of rows of the chunk (for the checkpoint),
+             a list of valid rows (dictionaries) and a list of (line number, error)
+    """
+    rows, errors = [], []
+    for line_number, row in chunk:
+        if not isinstance(row, dict):
+            errors.append((line_number, 'invalid row'))
+            continue
+        title = str(row.get('title') or '')
+        if NEEDS_CLEANING.search(title):
+            title = bleach.clean(title)
+        title = title.strip()
+        category = str(row.get('category') or '').strip()
+        inventory = row.get('inventory', row.get('stock'))
+        try:
+            price = Decimal(str(row.get('price')))
+            # NaN and Infinity are decimals too, but they can't be compared or saved
+            if not price.is_finite():
+                raise ValueError()
+            price = price.quantize(Decimal('0.01'))
+        except (InvalidOperation, ValueError):
+            errors.append((line_number, 'price is not a number'))
+            continue
+        try:
+            # like the serializer, "7" and "7.0" are accepted but not "7.5"
+            inventory = INVENTORY_FIELD.run_validation(inventory)
+        except serializers.ValidationError:
+            errors.append((line_number, 'inventory is not a whole number'))
+            continue
+        if not title or len(title) > TITLE_MAX_LENGTH:
+            errors.append((line_number, f'title should have between 1 and {TITLE_MAX_LENGTH} characters'))
+        elif not category:
+            errors.append((line_number, 'category is missing'))
+        elif price < MIN_PRICE:
+            errors.append((line_number, 'Price should not be less than 5.0'))
+        elif price > MAX_PRICE:
+            errors.append((line_number, f'Price should not be more than {MAX_PRICE}'))
+        elif inventory < 0:
+            errors.append((line_number, 'Stock cannot be negative'))
+        elif inventory > MAX_INVENTORY:
+            errors.append((line_number, f'Stock should not be more than {MAX_INVENTORY}'))
+        else:
+            rows.append({'line': line_number, 'title': title, 'price': price, 'inventory': inventory,
+                         'category': category})
+    return len(chunk), rows, errors
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Import menu items from a CSV or NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='the CSV or NDJSON (one JSON object per line) file')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='the file format, by default it comes from the file extension')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='rows validated and written together')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='number of validation processes')
+        parser.add_argument('--update', action='store_true',
+                            help='update the price, inventory and category of the titles that already exist '
+                                 '(by default they are skipped)')
+        parser.add_argument('--checkpoint', help='the checkpoint file, by default <path>.checkpoint')
+        parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the top')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        if not path.exists():
+            raise CommandError(f'{path} does not exist')
+        file_format = options['format'] or ('ndjson' if path.suffix in ('.ndjson', '.jsonl') else 'csv')
+        checkpoint = Path(options['checkpoint'] or f'{path}.checkpoint')
+        skip_rows = 0 if options['restart'] else self.read_checkpoint(checkpoint)
+        if skip_rows:
+            self.stdout.write(f'Resuming after {skip_rows} rows (checkpoint {checkpoint})')
+        if isinstance(cache, LocMemCache):
+            self.stderr.write(self.style.WARNING(
+                'The default cache is a local-memory cache: the running web workers will not see the new menu '
+                'versions, their cached menu stays until it expires (use a shared cache, e.g. Redis or Memcached)'))
+
+        # one query for all the categories, the rows only have the slug
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.update = options['update']
+        self.seen_titles = set()
+        imported = updated = skipped = failed = 0
+        processed = skip_rows
+        start = time.perf_counter()
+
+        rows = islice(read_rows(path, file_format), skip_rows, None)
+        # the workers are forked from this process, they must not inherit open database connections
+        connections.close_all()
+        with multiprocessing.Pool(options['workers']) as pool:
+            # imap keeps the order of the chunks, so the checkpoint is always a prefix of the file
+            for chunk_size, valid_rows, errors in pool.imap(validate_chunk, chunked(rows, options['chunk_size'])):
+                for line_number, error in errors:
+                    self.stderr.write(f'line {line_number}: {error}')
+                created, changed, duplicates, missing_category = self.write_chunk(valid_rows)
+                processed += chunk_size
+                self.write_checkpoint(checkpoint, processed)
+                imported += created
+                updated += changed
+                skipped += duplicates
+                failed += len(errors) + missing_category
+
+        checkpoint.unlink(missing_ok=True)
+        elapsed = time.perf_counter() - start
+        rate = (processed - skip_rows) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{imported} imported, {updated} updated, {skipped} skipped (already exist), {failed} failed '
+            f'in {elapsed:.1f}s ({rate:.0f} rows/sec)'))
+
+    def write_chunk(self, rows):
+        """
+        :param rows: the validated rows of one chunk
+        :return: the number of created, updated, duplicated and failed (unknown category) rows
+        """
+        missing_category = 0
+        new_rows = []
+        for row in rows:
+            category_id = self.categories.get(row['category'])
+            if category_id is None:
+                self.stderr.write(f"line {row['line']}: category {row['category']} does not exist")
+                missing_category += 1
+                continue
+            row['category_id'] = category_id
+            new_rows.append(row)
+
+        titles = [row['title'] for row in new_rows]
+        # one query to find the titles that already exist
+        existing = {
+            title: (pk, price, inventory, category_id)
+            for title, pk, price, inventory, category_id in MenuItem.objects.filter(title__in=titles).values_list(
+                'title', 'pk', 'price', 'inventory', 'category_id')
+        }
+        to_create, to_update, duplicates = [], [], 0
+        # the categories that gain or lose items
+        changed_categories = set()
+        for row in new_rows:
+            title = row['title']
+            if title in self.seen_titles:
+                # the same title more than once in the file, the first row wins
+                duplicates += 1
+                continue
+            self.seen_titles.add(title)
+            item = MenuItem(title=title, price=row['price'], inventory=row['inventory'],
+                            category_id=row['category_id'])
+            if title not in existing:
+                to_create.append(item)
+            elif self.update and existing[title][1:] != (item.price, item.inventory, item.category_id):
+                item.pk = existing[title][0]
+                to_update.append(item)
+                # a moved item changes the count of its old category too
+                changed_categories.update((existing[title][3], item.category_id))
+            else:
+                duplicates += 1
+
+        with transaction.atomic():
+            MenuItem.objects.bulk_create(to_create)
+            if to_update:
+                MenuItem.objects.bulk_update(to_update, ['price', 'inventory', 'category'],
+                                             batch_size=UPDATE_BATCH_SIZE)
+        # bulk_create/bulk_update don't send the post_save signals that bump the menu versions
+        if to_create or to_update:
+            menu_versions.bump_menu_version()
+        for item in to_update:
+            menu_versions.bump_item_version(item.pk)
+        changed_categories.update(item.category_id for item in to_create)
+        for category_id in changed_categories:
+            menu_versions.bump_category_version(category_id)
+        return len(to_create), len(to_update), duplicates, missing_category
+
+    @staticmethod
+    def read_checkpoint(checkpoint):
+        try:
+            return json.loads(checkpoint.read_text())['rows']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+
+    @staticmethod
+    def write_checkpoint(checkpoint, rows):
+        checkpoint.write_text(json.dumps({'rows': rows}))
+
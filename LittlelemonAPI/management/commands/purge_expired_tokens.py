@@ -0,0 +1,37 @@
+""" Delete the expired JWT tokens in small batches (see LittlelemonAPI/token_maintenance.py).
+
+    python manage.py purge_expired_tokens
+    python manage.py purge_expired_tokens --batch-size 1000 --max-batches 100
+    python manage.py purge_expired_tokens --stats
+
+The metrics of every run are saved in TOKEN_PURGE_METRICS_PATH, the api/token-store-metrics view reads them there. """
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from LittlelemonAPI.token_maintenance import purge_expired_tokens, token_store_stats, PurgeRunningError
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired outstanding and blacklisted JWT tokens in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.TOKEN_PURGE_BATCH_SIZE,
+                            help='tokens deleted in one transaction')
+        parser.add_argument('--max-batches', type=int, help='stop after this number of batches')
+        parser.add_argument('--pause', type=float, default=settings.TOKEN_PURGE_PAUSE,
+                            help='seconds to sleep between the batches')
+        parser.add_argument('--stats', action='store_true', help='only show the size of the token tables')
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            try:
+                metrics = purge_expired_tokens(options['batch_size'], options['max_batches'], options['pause'])
+            except PurgeRunningError:
+                raise CommandError('Another process is already purging the tokens')
+            self.stdout.write(self.style.SUCCESS(
+                f"Deleted {metrics['outstanding_deleted']} outstanding and {metrics['blacklisted_deleted']} "
+                f"blacklisted tokens in {metrics['batches']} batches, {metrics['seconds']}s "
+                f"({metrics['tokens_per_second']} tokens/sec)"))
+        for name, value in token_store_stats().items():
+            if name != 'last_purge':
+                self.stdout.write(f'{name}: {value}')
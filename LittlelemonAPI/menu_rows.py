@@ -0,0 +1,43 @@
+""" The whole menu serialized by MenuItemSerializerAutomatic, cached row by row.
+
+A row depends on its menu item and on its category (the category string shows the number of items),
+so it's cached under both versions (menu_versions.py): a saved item or category only re-serializes its own rows.
+All the rows are read in one cache call (get_many), the missing ones are loaded and serialized together,
+with the category counts of one GROUP BY query instead of one count() per row. """
+from django.conf import settings
+from django.core.cache import cache
+
+from LittlelemonAPI.menu_versions import get_item_versions, get_category_versions
+from LittlelemonAPI.models import MenuItem, preload_category_counts
+from LittlelemonAPI.serializers import MenuItemSerializerAutomatic
+
+# the number of missing rows loaded in one query (the size of the IN clause)
+LOAD_CHUNK_SIZE = 1000
+
+
+def row_key(pk, item_version, category_version):
+    return f'menu:row:{pk}:{item_version}:{category_version}'
+
+
+def get_serialized_rows():
+    """
+    :return: the list of all the menu items, serialized by MenuItemSerializerAutomatic
+    """
+    # the versions are read before the rows, so a row is never older than the versions of its key
+    # ordered by id, without order_by() the database could read the ids from the category index
+    ids = list(MenuItem.objects.order_by('pk').values_list('id', 'category_id'))
+    item_versions = get_item_versions([pk for pk, _ in ids])
+    category_versions = get_category_versions({category_id for _, category_id in ids})
+    keys = {pk: row_key(pk, item_versions[pk], category_versions[category_id]) for pk, category_id in ids}
+
+    rows = cache.get_many(list(keys.values()))
+    missing = [pk for pk, key in keys.items() if key not in rows]
+    for start in range(0, len(missing), LOAD_CHUNK_SIZE):
+        items = preload_category_counts(
+            MenuItem.objects.select_related('category').filter(pk__in=missing[start:start + LOAD_CHUNK_SIZE])
+        )
+        loaded = {keys[row['id']]: row for row in MenuItemSerializerAutomatic(items, many=True).data}
+        cache.set_many(loaded, timeout=settings.MENU_ROW_CACHE_TIMEOUT)
+        rows.update(loaded)
+    # an item deleted in the meantime has no row
+    return [rows[keys[pk]] for pk, _ in ids if keys[pk] in rows]
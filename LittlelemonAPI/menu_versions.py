@@ -0,0 +1,127 @@
+""" Version counters for the menu, kept in the shared cache.
+
+Every time a menu item or a category is saved/deleted we bump its version (see signals.py),
+anything that caches menu data can put the version in its cache key,
+so a changed row gets a new key and the old entry is simply never read again.
+For each menu version we also keep what changed for a while (the change log),
+so a copy of the menu (catalogue_index.py) can reload only the changed rows. """
+import time
+
+from django.core.cache import cache
+
+MENU_VERSION_KEY = 'menu:version'
+CHANGE_LOG_TIMEOUT = 60 * 60
+# more changes than this and it's faster to reload everything
+CHANGE_LOG_MAX_CHANGES = 1000
+
+
+def change_key(version):
+    return f'menu:change:{version}'
+
+
+def item_version_key(pk):
+    return f'menu:item:{pk}:version'
+
+
+def category_version_key(pk):
+    return f'menu:category:{pk}:version'
+
+
+def _seed():
+    # if a version key is missing (first use or evicted from the cache) we start it from the current time
+    # instead of 0, so it can never go back to a value that was already used for an older copy of the data
+    return int(time.time() * 1000)
+
+
+def get_versions(keys):
+    """
+    Read many version keys in one cache round trip
+    :param keys: the version keys to read
+    :return: a dictionary of key -> version
+    """
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        seed = _seed()
+        for key in missing:
+            # add() will not override a version that another process has just written
+            cache.add(key, seed, timeout=None)
+        versions.update(cache.get_many(missing))
+        # a full cache can evict the keys we have just added (e.g. LocMemCache culling),
+        # the seed is still a valid version, the next read will simply miss the entries built with it
+        for key in missing:
+            versions.setdefault(key, seed)
+    return versions
+
+
+def _bump(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # the key is not in the cache yet
+        version = _seed()
+        cache.set(key, version, timeout=None)
+        return version
+
+
+def get_menu_version():
+    return get_versions([MENU_VERSION_KEY])[MENU_VERSION_KEY]
+
+
+def get_item_versions(pks):
+    """
+    :param pks: the ids of the menu items
+    :return: a dictionary of menu item id -> version
+    """
+    versions = get_versions([item_version_key(pk) for pk in pks])
+    return {pk: versions[item_version_key(pk)] for pk in pks}
+
+
+def get_item_version(pk):
+    return get_item_versions([pk])[pk]
+
+
+def get_category_versions(pks):
+    """
+    :param pks: the ids of the categories
+    :return: a dictionary of category id -> version
+    """
+    versions = get_versions([category_version_key(pk) for pk in pks])
+    return {pk: versions[category_version_key(pk)] for pk in pks}
+
+
+def get_category_version(pk):
+    return get_category_versions([pk])[pk]
+
+
+def bump_menu_version(changed=None):
+    """
+    :param changed: what changed, ('item', pk) or ('category', pk), None when we don't know (e.g. a bulk import)
+    :return: the new menu version
+    """
+    version = _bump(MENU_VERSION_KEY)
+    cache.set(change_key(version), changed, timeout=CHANGE_LOG_TIMEOUT)
+    return version
+
+
+def get_menu_changes(since, until):
+    """
+    What changed after the version since, up to the version until
+    :return: a list of ('item', pk) / ('category', pk), or None if we can't know (reload everything)
+    """
+    if until <= since or until - since > CHANGE_LOG_MAX_CHANGES:
+        return None
+    keys = [change_key(version) for version in range(since + 1, until + 1)]
+    changes = cache.get_many(keys)
+    # a missing or unknown (None) change
+    if len(changes) != len(keys) or None in changes.values():
+        return None
+    return [tuple(changes[key]) for key in keys]
+
+
+def bump_item_version(pk):
+    return _bump(item_version_key(pk))
+
+
+def bump_category_version(pk):
+    return _bump(category_version_key(pk))
@@ -0,0 +1,188 @@
+""" A read-through cache for single menu items and categories, in two tiers:
+    1- a small LRU dictionary in each process (no object transfer, no unpickling),
+    2- the shared Django cache,
+and only then the database.
+
+Every entry remembers the versions (menu_versions.py) of what it was built from,
+e.g. a menu item depends on its own version and on the version of its category (the category string shows the
+number of items of the category). An entry is used only while those versions haven't changed, so a save/delete
+invalidates it everywhere without deleting anything. The versions are checked in the shared cache on every read,
+even for the local tier (one get_many of small integers), so a process never returns an object saved elsewhere.
+A missing object (404) is cached too, for a short time and only by its id, so the same wrong id doesn't hit the
+database every time, and scanning ids doesn't fill the cache with version keys. """
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+from LittlelemonAPI import menu_versions
+from LittlelemonAPI.models import MenuItem, Category
+
+MISSING = 'missing'
+
+
+class ObjectCache:
+
+    def __init__(self, model, version_key, load, dependencies=lambda obj: []):
+        """
+        :param model: the model class
+        :param version_key: pk -> the version key of the object
+        :param load: pk -> the object loaded from the database, raises model.DoesNotExist
+        :param dependencies: object -> the other version keys the object depends on
+        """
+        self.model = model
+        self.name = model._meta.model_name
+        self.version_key = version_key
+        self.load = load
+        self.dependencies = dependencies
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'negative_hits': 0, 'misses': 0}
+
+    def get_or_404(self, pk):
+        """
+        :return: the object with this primary key, or raise Http404 like get_object_or_404()
+        """
+        obj = self.get(pk)
+        if obj is None:
+            raise Http404(f'No {self.model._meta.object_name} matches the given query.')
+        return obj
+
+    def get(self, pk):
+        """
+        :return: the object with this primary key, or None if it doesn't exist
+        """
+        pk = int(pk)
+        # 1- the LRU of this process, we only check the versions (one cache call)
+        with self.lock:
+            entry = self.local.get(pk)
+            if entry is not None:
+                self.local.move_to_end(pk)
+        if entry is not None and self._is_current(entry):
+            return self._hit('local_hits', entry)
+
+        # 2- the shared cache, the key has the version of the object
+        primary_key, missing_key = self.version_key(pk), self.missing_key(pk)
+        dependencies_key = self.dependencies_key(pk)
+        found = cache.get_many([primary_key, missing_key, dependencies_key])
+        if missing_key in found:
+            entry = self._missing_entry(pk)
+            self._store_local(pk, entry)
+            return self._hit('negative_hits', entry)
+        version = found.get(primary_key)
+        if version is not None:
+            entry = cache.get(self._shared_key(pk, version))
+            if entry is not None and self._is_current(entry):
+                self._store_local(pk, entry)
+                return self._hit('shared_hits', entry)
+
+        # 3- the database
+        self._count('misses')
+        # like the version of the object, the versions of its dependencies are read before the query:
+        # a change committed after this read bumps them again, so an entry is never newer than its versions.
+        # The dependencies come from the object (e.g. its category), we use the ones of the last load
+        dependencies = found.get(dependencies_key, [])
+        versions = menu_versions.get_versions(dependencies) if dependencies else {}
+        try:
+            obj = self.load(pk)
+        except self.model.DoesNotExist:
+            # no version key for a missing object, only the short negative entry
+            cache.set(missing_key, True, timeout=settings.OBJECT_CACHE_NEGATIVE_TIMEOUT)
+            self._store_local(pk, self._missing_entry(pk))
+            return None
+        moved = self.dependencies(obj) != dependencies
+        if moved:
+            cache.set(dependencies_key, self.dependencies(obj), timeout=settings.OBJECT_CACHE_TIMEOUT)
+        if version is None:
+            # the first read of this object: we only create its version now that we know it exists,
+            # but a save could have happened after our query, so the object is cached from the next read
+            menu_versions.get_versions([primary_key])
+            return obj
+        if moved:
+            # we didn't know (or read the versions of) its current dependencies before the query
+            return obj
+        versions[primary_key] = version
+        entry = {'versions': versions, 'object': obj}
+        cache.set(self._shared_key(pk, version), entry, timeout=settings.OBJECT_CACHE_TIMEOUT)
+        self._store_local(pk, entry)
+        return obj
+
+    def missing_key(self, pk):
+        return f'object:{self.name}:{pk}:missing'
+
+    def dependencies_key(self, pk):
+        return f'object:{self.name}:{pk}:dependencies'
+
+    def forget_missing(self, pk):
+        """ The object has just been created, don't wait for the negative entry to expire """
+        cache.delete(self.missing_key(pk))
+
+    def _shared_key(self, pk, version):
+        return f'object:{self.name}:{pk}:{version}'
+
+    def _missing_entry(self, pk):
+        # valid while the negative entry is in the shared cache
+        return {'versions': {self.missing_key(pk): True}, 'object': MISSING}
+
+    def stats(self):
+        """ The hits of each tier since the process started """
+        with self.lock:
+            counters = dict(self.counters)
+            local_entries = len(self.local)
+        total = sum(counters.values())
+        return {
+            **counters,
+            'requests': total,
+            'local_hit_rate': round(counters['local_hits'] / total, 3) if total else 0,
+            'shared_hit_rate': round(counters['shared_hits'] / total, 3) if total else 0,
+            'negative_hit_rate': round(counters['negative_hits'] / total, 3) if total else 0,
+            'local_entries': local_entries,
+        }
+
+    @staticmethod
+    def _is_current(entry):
+        versions = entry['versions']
+        return cache.get_many(list(versions)) == versions
+
+    def _hit(self, counter, entry):
+        obj = entry['object']
+        if obj == MISSING:
+            self._count('negative_hits')
+            return None
+        self._count(counter)
+        return obj
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _store_local(self, pk, entry):
+        with self.lock:
+            self.local[pk] = entry
+            self.local.move_to_end(pk)
+            while len(self.local) > settings.OBJECT_CACHE_LOCAL_MAX_ENTRIES:
+                self.local.popitem(last=False)
+
+
+def _load_menu_item(pk):
+    item = MenuItem.objects.select_related('category').get(pk=pk)
+    # used by the category string (Category.__str__), so the serializer doesn't need another query
+    item.category.menu_items_count = item.category.menu_items.count()
+    return item
+
+
+menu_item_cache = ObjectCache(
+    MenuItem,
+    version_key=menu_versions.item_version_key,
+    load=_load_menu_item,
+    # the category string changes with the category (title, number of items)
+    dependencies=lambda item: [menu_versions.category_version_key(item.category_id)],
+)
+
+category_cache = ObjectCache(
+    Category,
+    version_key=menu_versions.category_version_key,
+    load=lambda pk: Category.objects.get(pk=pk),
+)
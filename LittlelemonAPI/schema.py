@@ -0,0 +1,95 @@
+""" The OpenAPI schema of the project, generated ahead of time and served from memory.
+
+Generating the schema walks every url pattern (ours, djoser and simplejwt) and introspects every serializer,
+so we don't do it on the request path:
+    python manage.py generate_openapi_schema    (run it on every deploy)
+writes the schema to OPENAPI_SCHEMA_PATH, each web process reads that file once when it starts (wsgi.py / asgi.py),
+renders it as JSON and YAML and keeps both in memory together with their ETag (a hash of the content).
+Without the file a production server doesn't start, with DEBUG on the file is generated at startup. """
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.renderers import OpenAPIRenderer
+from rest_framework.schemas.openapi import SchemaGenerator
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_TITLE = 'Little Lemon API'
+
+
+class PrecomputedSchema:
+    """ The rendered schema (JSON and YAML) and the ETag of each rendering """
+
+    def __init__(self, schema_json: bytes):
+        self.json = schema_json
+        self.yaml = OpenAPIRenderer().render(json.loads(schema_json))
+        content_hash = hashlib.sha256(schema_json).hexdigest()
+        self.json_etag = f'"{content_hash}-json"'
+        self.yaml_etag = f'"{content_hash}-yaml"'
+
+
+_schema = None
+_schema_lock = threading.Lock()
+
+
+def generate_schema_json():
+    """
+    Walk all the url patterns and build the schema, this is the slow part
+    :return: the schema as JSON bytes (the keys are sorted, so the same schema always gives the same hash)
+    """
+    schema = SchemaGenerator(title=SCHEMA_TITLE).get_schema(request=None, public=True)
+    return json.dumps(schema, sort_keys=True, indent=2).encode()
+
+
+def write_schema(path=None):
+    """
+    Generate the schema and save it to OPENAPI_SCHEMA_PATH
+    :return: the path of the file
+    """
+    path = Path(path or settings.OPENAPI_SCHEMA_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(generate_schema_json())
+    return path
+
+
+def load_schema():
+    """
+    Load the schema when the web process starts, so the requests never generate it.
+    With DEBUG on a missing file is generated (a development server works without the deploy step),
+    in production it raises ImproperlyConfigured and the server doesn't start.
+    """
+    global _schema
+    with _schema_lock:
+        try:
+            schema_json = _read_schema_json()
+        except ImproperlyConfigured:
+            if not settings.DEBUG:
+                raise
+            logger.warning('%s not found, generating it, run "manage.py generate_openapi_schema" when deploying',
+                           settings.OPENAPI_SCHEMA_PATH)
+            schema_json = Path(write_schema()).read_bytes()
+        _schema = PrecomputedSchema(schema_json)
+    return _schema
+
+
+def get_schema() -> PrecomputedSchema:
+    """ The schema of this process, loaded by load_schema() (or from the file if the process didn't call it) """
+    global _schema
+    if _schema is None:
+        with _schema_lock:
+            if _schema is None:
+                _schema = PrecomputedSchema(_read_schema_json())
+    return _schema
+
+
+def _read_schema_json():
+    try:
+        return Path(settings.OPENAPI_SCHEMA_PATH).read_bytes()
+    except FileNotFoundError:
+        raise ImproperlyConfigured(f'{settings.OPENAPI_SCHEMA_PATH} not found, '
+                                   f'run "manage.py generate_openapi_schema" when deploying')
@@ -0,0 +1,48 @@
+""" Keep the menu versions (menu_versions.py) up to date when the menu changes.
+
+The versions are bumped when the transaction is committed, not when the row is saved,
+otherwise another process could see the new version and read the old row again. """
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from LittlelemonAPI import menu_versions
+from LittlelemonAPI.models import MenuItem, Category
+from LittlelemonAPI.object_cache import menu_item_cache, category_cache
+
+
+@receiver(pre_save, sender=MenuItem)
+def menu_item_moving(sender, instance: MenuItem, **kwargs):
+    # if the item moves to another category, the old category loses one item too
+    if instance.pk:
+        old_category_id = MenuItem.objects.filter(pk=instance.pk).values_list('category_id', flat=True).first()
+        if old_category_id is not None and old_category_id != instance.category_id:
+            transaction.on_commit(lambda: menu_versions.bump_category_version(old_category_id))
+
+
+@receiver([post_save, post_delete], sender=MenuItem)
+def menu_item_changed(sender, instance: MenuItem, **kwargs):
+    # the pk is set to None after a delete, we keep it for the commit
+    pk, category_id = instance.pk, instance.category_id
+
+    def bump():
+        menu_versions.bump_item_version(pk)
+        # the category string shows the number of items, so the category changes with its items
+        menu_versions.bump_category_version(category_id)
+        menu_versions.bump_menu_version(changed=('item', pk))
+        # a new item can have the id of a recent 404
+        menu_item_cache.forget_missing(pk)
+
+    transaction.on_commit(bump)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, instance: Category, **kwargs):
+    pk = instance.pk
+
+    def bump():
+        menu_versions.bump_category_version(pk)
+        menu_versions.bump_menu_version(changed=('category', pk))
+        category_cache.forget_missing(pk)
+
+    transaction.on_commit(bump)
@@ -1,3 +1,662 @@
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock
+
+import yaml
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from LittlelemonAPI import catalogue_index, exports, menu_versions, token_maintenance
+from LittlelemonAPI.coalescing import single_flight
+from LittlelemonAPI.facets import compute_facets
+from LittlelemonAPI.management.commands import import_menu
+from LittlelemonAPI.menu_rows import get_serialized_rows
+from LittlelemonAPI.models import MenuItem, Category
+from LittlelemonAPI.object_cache import menu_item_cache, category_cache
+from LittlelemonAPI.serializers import MenuItemSerializerAutomatic
+
 
 # Create your tests here.
+
+class SingleFlightTests(TestCase):
+    """
+    The cache rebuilds of coalescing.single_flight()
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def run_threads(self, count, target):
+        """
+        Start count threads at the same time and wait for them
+        :return: the results (or the exceptions) of the threads
+        """
+        barrier = threading.Barrier(count)
+        results = [None] * count
+
+        def run(index):
+            barrier.wait()
+            try:
+                results[index] = target()
+            except Exception as error:
+                results[index] = error
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses_build_once(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            # slow enough for all the threads to miss the cache
+            time.sleep(0.2)
+            return 'menu'
+
+        results = self.run_threads(50, lambda: single_flight('test:menu', build, version=1))
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(results, ['menu'] * 50)
+        # the next request is a cache hit
+        self.assertEqual(single_flight('test:menu', build, version=1), 'menu')
+        self.assertEqual(len(builds), 1)
+
+    def test_waiters_get_the_stale_value_while_rebuilding(self):
+        single_flight('test:menu', lambda: 'old menu', version=1)
+        started, release = threading.Event(), threading.Event()
+
+        def slow_build():
+            started.set()
+            release.wait(5)
+            return 'new menu'
+
+        # the menu version changed, the leader rebuilds the value
+        leader = threading.Thread(target=single_flight, args=('test:menu', slow_build), kwargs={'version': 2})
+        leader.start()
+        self.assertTrue(started.wait(5))
+        try:
+            # the other requests don't build it again, they get the old value right away
+            other_builds = []
+            value = single_flight('test:menu', lambda: other_builds.append(1), version=2)
+            self.assertEqual(value, 'old menu')
+            self.assertEqual(other_builds, [])
+        finally:
+            release.set()
+            leader.join()
+        self.assertEqual(single_flight('test:menu', lambda: 'unexpected', version=2), 'new menu')
+
+    def test_stale_value_while_another_process_rebuilds(self):
+        single_flight('test:menu', lambda: 'old menu', version=1)
+        # the lock of another process in the shared cache
+        cache.add('test:menu:lock', 'another process', timeout=30)
+        builds = []
+        value = single_flight('test:menu', lambda: builds.append(1), version=2)
+        self.assertEqual(value, 'old menu')
+        self.assertEqual(builds, [])
+
+    def test_builder_error_reaches_the_waiters(self):
+        started, release = threading.Event(), threading.Event()
+
+        def failing_build():
+            started.set()
+            release.wait(5)
+            raise ValueError('the database is down')
+
+        results = []
+
+        def request(build):
+            try:
+                results.append(single_flight('test:menu', build, version=1))
+            except Exception as error:
+                results.append(error)
+
+        leader = threading.Thread(target=request, args=(failing_build,))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        waiter_builds = []
+        waiters = [threading.Thread(target=request, args=(lambda: waiter_builds.append(1),)) for _ in range(5)]
+        for waiter in waiters:
+            waiter.start()
+        # let the waiters block on the leader
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader, *waiters]:
+            thread.join()
+
+        self.assertEqual(waiter_builds, [])
+        self.assertEqual(len(results), 6)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        # nothing was cached, the next request builds the value again
+        self.assertEqual(single_flight('test:menu', lambda: 'menu', version=1), 'menu')
+
+
+class MenuListCacheTests(TestCase):
+    """
+    The cached pages of MenuItemView
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(slug='mains', title='Mains')
+        for title in ('Pasta', 'Pizza', 'Salad'):
+            MenuItem.objects.create(title=title, price=10, inventory=5, category=category)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unused_parameters_share_the_cached_page(self):
+        first = self.client.get('/api/menu-items', {'page': 1, 'ordering': '-title'})
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/menu-items', {'ordering': '-title', 'page': 1, 'utm_source': 'mail'})
+        self.assertEqual(second.json(), first.json())
+
+    def test_pages_are_cached_separately(self):
+        first = self.client.get('/api/menu-items', {'page': 1}).json()
+        second = self.client.get('/api/menu-items', {'page': 2}).json()
+        self.assertEqual(first['count'], 3)
+        self.assertEqual(len(first['results']) + len(second['results']), 3)
+        self.assertNotEqual(first['results'], second['results'])
+
+
+class MenuFacetsTests(TestCase):
+    """
+    The facet counts of menu_items_filter_data (facets.py)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.drinks = Category.objects.create(slug='drinks', title='Drinks')
+        cls.desserts = Category.objects.create(slug='desserts', title='Desserts')
+        for title, price, category in [('Lemonade', 5, cls.drinks), ('Iced tea', 12, cls.drinks),
+                                       ('Lemon juice', 25, cls.drinks), ('Lemon cake', 15, cls.desserts),
+                                       ('Cheesecake', 60, cls.desserts), ('Wedding cake', 150, cls.desserts)]:
+            MenuItem.objects.create(title=title, price=price, inventory=10, category=category)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            facets = compute_facets(MenuItem.objects.all())
+        self.assertEqual(facets['total'], 6)
+        self.assertEqual([(category['title'], category['count']) for category in facets['categories']],
+                         [('Desserts', 3), ('Drinks', 3)])
+        self.assertEqual([(price_range['range'], price_range['count']) for price_range in facets['price_ranges']],
+                         [('<10', 1), ('10-20', 2), ('20-50', 1), ('50-100', 1), ('>=100', 1)])
+
+    def test_facets_of_the_filtered_items(self):
+        response = self.client.get('/api/menu_items_filter_data',
+                                   {'search': 'Lemon', 'to_price': '20', 'facets': 'true', 'perpage': 1})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        # Lemonade and Lemon cake, Lemon juice is too expensive
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual({category['title']: category['count'] for category in data['facets']['categories']},
+                         {'Drinks': 1, 'Desserts': 1})
+        self.assertEqual([price_range['count'] for price_range in data['facets']['price_ranges']], [1, 1, 0, 0, 0])
+
+
+class CatalogueIndexTests(TestCase):
+    """
+    menu_items_filter_data answers the same from the database and from the catalogue index (catalogue_index.py)
+    """
+    QUERIES = [
+        {},
+        {'search': 'lemon'},
+        {'search': 'LEMON cake'},
+        {'search': 'Tea'},
+        {'category': 'drinks'},
+        {'category': 'Desserts', 'ordering': '-price'},
+        {'to_price': '14.99'},
+        {'to_price': '30', 'ordering': '-inventory'},
+        {'search': 'cake', 'ordering': 'price,inventory', 'facets': 'true'},
+        {'category': 'Drinks', 'search': 'e', 'to_price': '100', 'ordering': '-price', 'perpage': 2, 'page': 2},
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        drinks = Category.objects.create(slug='drinks', title='Drinks')
+        desserts = Category.objects.create(slug='desserts', title='Desserts')
+        for index, (title, price, category) in enumerate([
+                ('Lemonade', '5.00', drinks), ('Iced Tea', '12.50', drinks), ('Lemon Juice', '25.00', drinks),
+                ('lemon cake', '15.00', desserts), ('Cheesecake', '60.00', desserts),
+                ('Wedding CAKE', '150.00', desserts), ('Sparkling tea', '14.99', drinks)]):
+            MenuItem.objects.create(title=title, price=price, inventory=10 + index * 7 % 5, category=category)
+
+    def setUp(self):
+        cache.clear()
+        # a new index for every test, it must not keep the items of another test
+        patcher = mock.patch.object(catalogue_index, '_index', catalogue_index.CatalogueIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def filter_data(self, params, use_index):
+        with self.settings(MENU_CATALOGUE_INDEX=use_index):
+            response = self.client.get('/api/menu_items_filter_data', {'perpage': 20, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def assertSameResults(self):
+        for params in self.QUERIES:
+            with self.subTest(params=params):
+                expected = self.filter_data(params, use_index=False)
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.filter_data(params, use_index=True), expected)
+
+    def test_same_results_as_the_database(self):
+        # the first query loads the index
+        self.filter_data({}, use_index=True)
+        self.assertSameResults()
+
+    def test_changes_are_applied_to_the_index(self):
+        self.filter_data({}, use_index=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            cake = MenuItem.objects.get(title='lemon cake')
+            cake.title = 'Lemon Pie'
+            cake.price = '9.00'
+            cake.save()
+            MenuItem.objects.get(title='Cheesecake').delete()
+            MenuItem.objects.create(title='Lemon tart', price='7.25', inventory=3, category_id=cake.category_id)
+        self.filter_data({}, use_index=True)
+        self.assertSameResults()
+
+
+class ObjectCacheTests(TestCase):
+    """
+    The cache of single menu items and categories (object_cache.py)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(slug='drinks', title='Drinks')
+        cls.item = MenuItem.objects.create(title='Lemonade', price='5.00', inventory=10, category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+        for object_cache in (menu_item_cache, category_cache):
+            object_cache.local.clear()
+
+    def get_item(self, pk):
+        response = self.client.get(f'/api/menu-items/{pk}')
+        return response.status_code, response.json()
+
+    def test_hot_reads_need_no_query(self):
+        self.get_item(self.item.pk)
+        # the first read creates the version of the item, the second one caches it
+        self.get_item(self.item.pk)
+        with self.assertNumQueries(0):
+            status_code, data = self.get_item(self.item.pk)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data['title'], 'Lemonade')
+        self.assertEqual(data['category_str'], 'Drinks || 1')
+
+    def test_save_and_delete_invalidate(self):
+        for _ in range(2):
+            self.get_item(self.item.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            MenuItem.objects.filter(pk=self.item.pk).update(title='Pink lemonade')
+            # update() doesn't send signals, save() does
+            item = MenuItem.objects.get(pk=self.item.pk)
+            item.save()
+        self.assertEqual(self.get_item(self.item.pk)[1]['title'], 'Pink lemonade')
+
+        # the category string shows the number of items, a new item of the category changes it
+        with self.captureOnCommitCallbacks(execute=True):
+            MenuItem.objects.create(title='Iced tea', price='6.00', inventory=3, category=self.category)
+        self.assertEqual(self.get_item(self.item.pk)[1]['category_str'], 'Drinks || 2')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            item.delete()
+        self.assertEqual(self.get_item(self.item.pk)[0], 404)
+
+    def test_missing_objects_are_cached_for_a_short_time(self):
+        missing_pk = self.item.pk + 1000
+        with self.settings(OBJECT_CACHE_NEGATIVE_TIMEOUT=60):
+            self.assertEqual(self.get_item(missing_pk)[0], 404)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.get_item(missing_pk)[0], 404)
+            # a wrong id doesn't create a version key that would stay in the cache forever
+            self.assertIsNone(cache.get(menu_versions.item_version_key(missing_pk)))
+
+            # the cache expires its entries with time.time()
+            with mock.patch('time.time', return_value=time.time() + 61), self.assertNumQueries(1):
+                self.assertEqual(self.get_item(missing_pk)[0], 404)
+
+    def test_created_object_is_not_hidden_by_a_cached_404(self):
+        missing_pk = self.item.pk + 1000
+        self.assertEqual(self.get_item(missing_pk)[0], 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            MenuItem.objects.create(pk=missing_pk, title='Iced tea', price='6.00', inventory=3,
+                                    category=self.category)
+        self.assertEqual(self.get_item(missing_pk)[0], 200)
+
+
+    def test_category_change_during_the_load_is_not_cached(self):
+        self.get_item(self.item.pk)
+        load = menu_item_cache.load
+
+        def load_then_change_the_category(pk):
+            item = load(pk)
+            # another request adds an item to the category right after our query
+            with self.captureOnCommitCallbacks(execute=True):
+                MenuItem.objects.create(title='Iced tea', price='6.00', inventory=3, category=self.category)
+            return item
+
+        with mock.patch.object(menu_item_cache, 'load', side_effect=load_then_change_the_category):
+            self.assertEqual(self.get_item(self.item.pk)[1]['category_str'], 'Drinks || 1')
+        # the entry has the category version read before the query, it's already out of date
+        self.assertEqual(self.get_item(self.item.pk)[1]['category_str'], 'Drinks || 2')
+
+    def test_moved_item_depends_on_its_new_category(self):
+        for _ in range(2):
+            self.get_item(self.item.pk)
+        desserts = Category.objects.create(slug='desserts', title='Desserts')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.category = desserts
+            self.item.save()
+        self.assertEqual(self.get_item(self.item.pk)[1]['category_str'], 'Desserts || 1')
+        with self.captureOnCommitCallbacks(execute=True):
+            MenuItem.objects.create(title='Tiramisu', price='7.00', inventory=3, category=desserts)
+        self.assertEqual(self.get_item(self.item.pk)[1]['category_str'], 'Desserts || 2')
+
+
+class MenuRowsTests(TestCase):
+    """
+    The serialized rows of the menu-items.html page (menu_rows.py)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(slug='drinks', title='Drinks')
+        MenuItem.objects.bulk_create(
+            MenuItem(title=f'Lemonade {i}', price=5 + i, inventory=i, category=cls.category) for i in range(30)
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_same_rows_as_the_serializer(self):
+        items = MenuItem.objects.select_related('category').order_by('pk')
+        expected = MenuItemSerializerAutomatic(items, many=True).data
+        self.assertEqual(get_serialized_rows(), expected)
+        # the second call reads every row from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(get_serialized_rows(), expected)
+
+    def test_changed_rows_are_serialized_again(self):
+        get_serialized_rows()
+        with self.captureOnCommitCallbacks(execute=True):
+            item = MenuItem.objects.order_by('pk').first()
+            item.title = 'Pink lemonade'
+            item.save()
+            MenuItem.objects.create(title='Iced tea', price=6, inventory=1, category=self.category)
+        rows = get_serialized_rows()
+        self.assertEqual(rows[0]['title'], 'Pink lemonade')
+        # the category string of every row shows the new number of items
+        self.assertEqual({row['category_str'] for row in rows}, {'Drinks || 31'})
+
+    def test_page_works_when_the_cache_is_full(self):
+        # the cache culls the version keys while they are added, the page still renders every item
+        small_cache = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                   'LOCATION': 'menu-rows-test', 'OPTIONS': {'MAX_ENTRIES': 10}}}
+        with self.settings(CACHES=small_cache):
+            response = self.client.get('/api/menu-templateHtmlFormRenderer')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count(b'<tr>'), 31)
+
+
+class SynchronousExecutor:
+    """ Runs the export jobs in the test process, instead of the process pool """
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+
+class ExportTests(TestCase):
+    """
+    The background exports (exports.py)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(slug='desserts', title='Desserts')
+        for title in ('Tiramisu', 'Gelato', 'Baklava'):
+            MenuItem.objects.create(title=title, price=7, inventory=3, category=category)
+
+    def setUp(self):
+        cache.clear()
+        export_root = tempfile.TemporaryDirectory()
+        self.addCleanup(export_root.cleanup)
+        self.root = Path(export_root.name)
+        settings_override = self.settings(EXPORT_ROOT=self.root, EXPORT_CHUNK_SIZE=2, EXPORT_RESULT_TTL=60)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        executor = mock.patch.object(exports, '_get_executor', return_value=SynchronousExecutor())
+        executor.start()
+        self.addCleanup(executor.stop)
+
+    def write_job(self, status, created_at, export_format='csv'):
+        job = {'id': uuid.uuid4().hex, 'format': export_format, 'status': status, 'processed': 0, 'total': None,
+               'created_at': created_at, 'finished_at': None, 'error': None}
+        exports._write_job(job)
+        return job
+
+    def test_submit_poll_and_download(self):
+        response = self.client.post('/api/menu-exports', {'format': 'csv'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], exports.QUEUED)
+
+        job = self.client.get(response.data['url']).json()
+        self.assertEqual(job['status'], exports.DONE)
+        self.assertEqual((job['processed'], job['total']), (3, 3))
+
+        download = self.client.get(job['download_url'])
+        self.assertEqual(download.status_code, 200)
+        lines = b''.join(download.streaming_content).decode().splitlines()
+        # one header and one line for each item, over two chunks
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(sum('Tiramisu' in line for line in lines), 1)
+        self.assertEqual(list(self.root.glob('*.part')), [])
+
+    def test_yaml_export(self):
+        response = self.client.post('/api/menu-exports', {'format': 'yaml'})
+        job = self.client.get(response.data['url']).json()
+        content = b''.join(self.client.get(job['download_url']).streaming_content).decode()
+        # the chunks make one list
+        self.assertEqual(sorted(item['title'] for item in yaml.safe_load(content)), ['Baklava', 'Gelato', 'Tiramisu'])
+
+    def test_unknown_jobs(self):
+        self.assertEqual(self.client.get(f'/api/menu-exports/{uuid.uuid4().hex}').status_code, 404)
+        self.assertEqual(self.client.get('/api/menu-exports/not-a-job').status_code, 404)
+        self.assertEqual(self.client.post('/api/menu-exports', {'format': 'xls'}).status_code, 400)
+        # a job purged before a worker started it
+        self.assertIsNone(exports.run_export(uuid.uuid4().hex))
+
+    def test_expired_jobs_are_purged(self):
+        old = time.time() - 120
+        done = self.write_job(exports.DONE, old)
+        exports.get_result_path(done).write_text('menu')
+        # still updated by its worker
+        running = self.write_job(exports.RUNNING, old)
+        (self.root / f"{running['id']}.part").write_text('half a menu')
+        # lost when the server restarted
+        lost = self.write_job(exports.QUEUED, old)
+        os.utime(exports._job_path(lost['id']), (old, old))
+        orphan = self.root / f'{uuid.uuid4().hex}.part'
+        orphan.write_text('half a menu')
+        os.utime(orphan, (old, old))
+        recent = self.write_job(exports.DONE, time.time())
+
+        exports.purge_expired_exports()
+
+        self.assertIsNone(exports.get_job(done['id']))
+        self.assertFalse(exports.get_result_path(done).exists())
+        self.assertIsNotNone(exports.get_job(running['id']))
+        self.assertTrue((self.root / f"{running['id']}.part").exists())
+        self.assertIsNone(exports.get_job(lost['id']))
+        self.assertFalse(orphan.exists())
+        self.assertIsNotNone(exports.get_job(recent['id']))
+
+
+class ImportMenuTests(TestCase):
+    """
+    The menu versions bumped by the import_menu command
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.drinks = Category.objects.create(slug='drinks', title='Drinks')
+        self.desserts = Category.objects.create(slug='desserts', title='Desserts')
+        self.item = MenuItem.objects.create(title='Affogato', price=6, inventory=4, category=self.drinks)
+        self.command = import_menu.Command()
+        self.command.categories = {'drinks': self.drinks.pk, 'desserts': self.desserts.pk}
+        self.command.update = True
+        self.command.seen_titles = set()
+
+    def test_moved_item_bumps_both_categories(self):
+        versions = menu_versions.get_category_versions([self.drinks.pk, self.desserts.pk])
+        item_version = menu_versions.get_item_version(self.item.pk)
+
+        created, updated, _, _ = self.command.write_chunk([
+            {'line': 2, 'title': 'Affogato', 'price': Decimal('6.00'), 'inventory': 4, 'category': 'desserts'},
+        ])
+
+        self.assertEqual((created, updated), (0, 1))
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.category_id, self.desserts.pk)
+        self.assertGreater(menu_versions.get_item_version(self.item.pk), item_version)
+        new_versions = menu_versions.get_category_versions([self.drinks.pk, self.desserts.pk])
+        # the drinks lost one item
+        self.assertGreater(new_versions[self.drinks.pk], versions[self.drinks.pk])
+        self.assertGreater(new_versions[self.desserts.pk], versions[self.desserts.pk])
+
+
+class TokenPurgeTests(TestCase):
+    """
+    The purge of the expired refresh tokens (token_maintenance.py)
+    """
+
+    def setUp(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        settings_override = self.settings(TOKEN_PURGE_METRICS_PATH=Path(metrics_dir.name) / 'metrics.json')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        now = aware_utcnow()
+        self.expired, self.valid = [], []
+        # the expired tokens come first, with one valid token among them (e.g. a longer lifetime)
+        for index, expired in enumerate([True] * 3 + [False] + [True] * 2 + [False] * 2):
+            expires_at = now - timedelta(days=1) if expired else now + timedelta(days=1)
+            token = OutstandingToken.objects.create(jti=uuid.uuid4().hex, token=f'token {index}',
+                                                    created_at=now - timedelta(days=2), expires_at=expires_at)
+            (self.expired if expired else self.valid).append(token.pk)
+        BlacklistedToken.objects.create(token_id=self.expired[0])
+        BlacklistedToken.objects.create(token_id=self.valid[0])
+
+    def test_purge_in_batches(self):
+        metrics = token_maintenance.purge_expired_tokens(batch_size=2)
+
+        self.assertEqual(metrics['batches'], 3)
+        self.assertEqual((metrics['outstanding_deleted'], metrics['blacklisted_deleted']), (5, 1))
+        self.assertFalse(OutstandingToken.objects.filter(pk__in=self.expired).exists())
+        # the valid token between the expired ones (before the cutoff) is kept
+        self.assertEqual(sorted(OutstandingToken.objects.values_list('pk', flat=True)), self.valid)
+        self.assertEqual(BlacklistedToken.objects.get().token_id, self.valid[0])
+
+    def test_max_batches_and_metrics(self):
+        first = token_maintenance.purge_expired_tokens(batch_size=2, max_batches=1)
+        self.assertEqual((first['batches'], first['outstanding_deleted']), (1, 2))
+        self.assertEqual(token_maintenance.read_purge_metrics(), {'total_purged': 2, 'last_purge': first})
+
+        # the next run continues with the tokens left
+        second = token_maintenance.purge_expired_tokens(batch_size=2)
+        self.assertEqual(second['outstanding_deleted'], 3)
+        stats = token_maintenance.token_store_stats()
+        self.assertEqual(stats['total_purged'], 5)
+        self.assertEqual(stats['last_purge'], second)
+        self.assertEqual((stats['outstanding_tokens'], stats['expired_tokens']), (3, 0))
+
+    def test_only_one_purge_at_a_time(self):
+        with token_maintenance._purge_lock() as locked:
+            self.assertTrue(locked)
+            with self.assertRaises(token_maintenance.PurgeRunningError):
+                token_maintenance.purge_expired_tokens()
+        self.assertEqual(OutstandingToken.objects.count(), 8)
+        # the lock is released
+        self.assertEqual(token_maintenance.purge_expired_tokens()['outstanding_deleted'], 5)
+
+
+class BatchTests(TestCase):
+    """
+    The batch endpoint (batch.py)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('waiter', password='lemon-pass-123')
+        category = Category.objects.create(slug='starters', title='Starters')
+        MenuItem.objects.create(title='Bruschetta', price=8, inventory=10, category=category)
+
+    def setUp(self):
+        # the throttles count the calls in the cache
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def post_batch(self, body):
+        return self.client.post('/api/batch', body, content_type='application/json')
+
+    def test_every_sub_request_has_its_own_response(self):
+        response = self.post_batch({'requests': [
+            {'path': 'secret_request'},
+            {'method': 'GET', 'path': '/api/menu_CSVRenderer'},
+            {'path': 'not-an-endpoint'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        secret, menu_csv, missing = response.json()['responses']
+        self.assertEqual(secret, {'status': 200, 'body': {'message': 'This is a secret message'}})
+        # without an Accept header the view answers with its only renderer
+        self.assertEqual(menu_csv['status'], 200)
+        self.assertTrue(menu_csv['headers']['Content-Type'].startswith('text/csv'))
+        self.assertIn('Bruschetta', menu_csv['body'])
+        self.assertEqual(missing['status'], 404)
+
+    def test_permissions_apply_to_every_sub_request(self):
+        response = self.post_batch({'requests': [{'path': 'token-store-metrics'}, {'path': 'secret_request'}],
+                                    'concurrent': True})
+        self.assertEqual([result['status'] for result in response.json()['responses']], [403, 200])
+
+    def test_throttles_apply_to_every_sub_request(self):
+        # TenCallsPerMinuteThrottle lets 10 calls through
+        response = self.post_batch({'requests': [{'path': 'throttle_check_auth'}] * 11})
+        statuses = [result['status'] for result in response.json()['responses']]
+        self.assertEqual(statuses, [200] * 10 + [429])
+
+    def test_invalid_batches(self):
+        for body in [
+            {'requests': []},
+            {'requests': [{'method': 5, 'path': 'secret_request'}]},
+            {'requests': [{'method': 'TRACE', 'path': 'secret_request'}]},
+            {'requests': [{'path': 'secret_request'}], 'concurrent': 'false'},
+            {'requests': [{'path': 'secret_request'}] * 21},
+        ]:
+            with self.subTest(body=body):
+                self.assertEqual(self.post_batch(body).status_code, 400)
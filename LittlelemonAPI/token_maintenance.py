@@ -0,0 +1,201 @@
+""" Purge the expired JWT refresh tokens from the token_blacklist tables.
+
+simplejwt saves every refresh token in OutstandingToken (and BlacklistedToken when it's blacklisted),
+nothing deletes them, so the tables grow forever and the blacklist checks get slower.
+simplejwt's own flushexpiredtokens command deletes everything in one statement (a long lock on a big table),
+here we delete in small batches, each batch in its own short transaction:
+    - the ids are taken in primary key order, the tokens are created in that order with the same lifetime,
+      so the expired ones are at the start of the primary key index and every batch is a short index range scan,
+    - the blacklisted rows of the batch are deleted first, then the outstanding rows,
+    - the metrics of the purges are kept in a file, so the web workers can show the purges of the command.
+
+It runs with "manage.py purge_expired_tokens", or in the web process every TOKEN_PURGE_INTERVAL seconds. """
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import transaction, connections
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+logger = logging.getLogger(__name__)
+
+
+class PurgeRunningError(Exception):
+    """ Raised when another process is already purging the tokens """
+
+
+def purge_expired_tokens(batch_size=None, max_batches=None, pause=0.0):
+    """
+    Delete the expired outstanding tokens (and their blacklist entries) in small batches,
+    only one process (web worker or management command) purges at a time
+    :param batch_size: the number of tokens deleted in one transaction
+    :param max_batches: stop after this number of batches (None: until there are no expired tokens)
+    :param pause: seconds to sleep between the batches, to leave room for the other queries
+    :return: the metrics of this run
+    """
+    with _purge_lock() as locked:
+        if not locked:
+            raise PurgeRunningError()
+        metrics = _purge(batch_size or settings.TOKEN_PURGE_BATCH_SIZE, max_batches, pause)
+        total = read_purge_metrics()['total_purged'] + metrics['outstanding_deleted']
+        _write_purge_metrics({'total_purged': total, 'last_purge': metrics})
+    return metrics
+
+
+def _purge(batch_size, max_batches, pause):
+    now = aware_utcnow()
+    outstanding_deleted = blacklisted_deleted = batches = 0
+    start = time.perf_counter()
+
+    # there is no index on expires_at, so a filter on it alone reads the valid tokens until the end of the table
+    # to know that there are no more expired ones. We read them only once, backwards from the end of the
+    # primary key index until the last expired token, then every batch stops at the id of that token
+    cutoff = (OutstandingToken.objects.filter(expires_at__lte=now)
+              .order_by('-id').values_list('id', flat=True).first())
+    expired = OutstandingToken.objects.filter(expires_at__lte=now, id__lte=cutoff or 0)
+
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        # order_by('id') also removes the default ordering of the model (by user)
+        ids = list(expired.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            blacklisted_deleted += BlacklistedToken.objects.filter(token_id__in=ids).delete()[0]
+            outstanding_deleted += OutstandingToken.objects.filter(id__in=ids).delete()[0]
+        batches += 1
+        last_id = ids[-1]
+        # a partial batch was the last one, we don't need another (empty) query
+        if len(ids) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    seconds = time.perf_counter() - start
+    return {
+        'finished_at': now.isoformat(),
+        'batches': batches,
+        'outstanding_deleted': outstanding_deleted,
+        'blacklisted_deleted': blacklisted_deleted,
+        'seconds': round(seconds, 3),
+        'tokens_per_second': round(outstanding_deleted / seconds, 1) if seconds else 0,
+    }
+
+
+# The metrics and the lock are files (TOKEN_PURGE_METRICS_PATH), not cache keys:
+# the purge usually runs in the management command (cron), a process that ends right after,
+# and the default cache can be per process (LocMemCache), so the web workers would never see them.
+# The command and the web workers must run on the same host (or share the directory).
+
+def _metrics_path():
+    path = Path(settings.TOKEN_PURGE_METRICS_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _try_lock(lock_file):
+    """
+    Lock the file without waiting: flock() on POSIX, msvcrt.locking() on Windows (there is no fcntl module)
+    :return: a function that releases the lock, or None if another process holds it
+    """
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return None
+        return lambda: msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return None
+    return lambda: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _purge_lock():
+    # both locks are released by the system if the process dies, a crashed purge never keeps the lock
+    with open(_metrics_path().with_suffix('.lock'), 'w') as lock_file:
+        unlock = _try_lock(lock_file)
+        if unlock is None:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            unlock()
+
+
+def read_purge_metrics():
+    """
+    :return: the number of tokens purged since the metrics file was created and the metrics of the last purge
+    """
+    try:
+        return json.loads(_metrics_path().read_text())
+    except (FileNotFoundError, ValueError):
+        return {'total_purged': 0, 'last_purge': None}
+
+
+def _write_purge_metrics(metrics):
+    # write to a temporary file and rename it, so a reader never reads half a file
+    path = _metrics_path()
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(metrics))
+    os.replace(tmp_path, path)
+
+
+def token_store_stats():
+    """
+    :return: the size of the token tables and the metrics of the last purge
+    """
+    return {
+        'outstanding_tokens': OutstandingToken.objects.count(),
+        'blacklisted_tokens': BlacklistedToken.objects.count(),
+        'expired_tokens': OutstandingToken.objects.filter(expires_at__lte=aware_utcnow()).count(),
+        **read_purge_metrics(),
+    }
+
+
+def _purge_periodically(interval):
+    while True:
+        time.sleep(interval)
+        # only one process purges in each interval, the others see the last purge in the metrics
+        last_purge = read_purge_metrics()['last_purge']
+        if last_purge:
+            since_last_purge = aware_utcnow() - datetime.fromisoformat(last_purge['finished_at'])
+            if since_last_purge.total_seconds() < interval:
+                continue
+        try:
+            metrics = purge_expired_tokens(pause=settings.TOKEN_PURGE_PAUSE)
+            logger.info('Purged %s expired tokens in %ss', metrics['outstanding_deleted'], metrics['seconds'])
+        except PurgeRunningError:
+            pass
+        except Exception:
+            logger.exception('The expired tokens purge failed')
+        finally:
+            # the connections are per thread, this only closes the connection of the purge thread
+            connections.close_all()
+
+
+def _start_on_first_request(sender, **kwargs):
+    # disconnect() returns False in the other threads that received the first requests at the same time
+    if not request_started.disconnect(_start_on_first_request):
+        return
+    threading.Thread(target=_purge_periodically, args=(settings.TOKEN_PURGE_INTERVAL,),
+                     name='token-purge', daemon=True).start()
+
+
+def enable_periodic_purge():
+    """ Start the purge thread with the first request of the process (not in the management commands) """
+    if settings.TOKEN_PURGE_INTERVAL:
+        request_started.connect(_start_on_first_request)
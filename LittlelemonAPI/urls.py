@@ -7,10 +7,11 @@ from LittlelemonAPI.views import (
     category_detail,
     menu_items,
     menu_items_save_to_modelDserializer,
-    menu_items_basic_fetch_data, single_item_basic_fetch_data, menu_OpenAPIRenderer,
+    menu_items_basic_fetch_data, single_item_basic_fetch_data, menu_OpenAPIRenderer, menu_JsonOpenAPIRenderer,
     menu_TemplateHTMLFormRendererRenderer, menu_StaticHTMLRenderer, menu_CSVRenderer, menu_YAMLRenderer,
     menu_items_filter_data, MenuItemModelView, secret_request, manger_request, throttle_check, throttle_check_auth,
-    managers_only
+    managers_only, menu_exports, menu_export_detail, menu_export_download, token_store_metrics, batch,
+    object_cache_metrics
 )
 
 urlpatterns = [
@@ -34,12 +35,18 @@ urlpatterns = [
     path('menu-items-save/<int:pk>', menu_items_save_to_modelDserializer, name='menu-items-save'),
 
     path('menu-OpenAPIRenderer', menu_OpenAPIRenderer, name='menu-items-api-view'),
+    path('menu-JsonOpenAPIRenderer', menu_JsonOpenAPIRenderer, name='menu-items-api-view'),
     path('menu-templateHtmlFormRenderer', menu_TemplateHTMLFormRendererRenderer, name='menu-items-api-view'),
     path('menu-StaticHTMLRenderer', menu_StaticHTMLRenderer, name='menu-items-api-view'),
     path('menu_YAMLRenderer', menu_YAMLRenderer, name='menu-items-api-view'),
     path('menu_CSVRenderer', menu_CSVRenderer, name='menu-items-api-view'),
     path('menu_items_filter_data', menu_items_filter_data, name='menu_items_filter_data'),
 
+    # background exports
+    path('menu-exports', menu_exports, name='menu-exports'),
+    path('menu-exports/<str:job_id>', menu_export_detail, name='menu-export-detail'),
+    path('menu-exports/<str:job_id>/download', menu_export_download, name='menu-export-download'),
+
     path('menu-items-model-viewset', MenuItemModelView.as_view({'get': 'list'}), name='menu-items-model-viewset'),
     path('menu-items-model-viewset/<int:pk>', MenuItemModelView.as_view({'get': 'retrieve'}), name='menu-items-model-viewset'),
     path('secret_request', secret_request, name='secret_request'),
@@ -48,6 +55,9 @@ urlpatterns = [
     path('throttle_check', throttle_check, name='throttle_check'),
     path('throttle_check_auth', throttle_check_auth, name='throttle_check_auth'),
     path('groups/managers/users/', managers_only),
+    path('token-store-metrics', token_store_metrics, name='token-store-metrics'),
+    path('object-cache-metrics', object_cache_metrics, name='object-cache-metrics'),
+    path('batch', batch, name='batch'),
 
     # this is provided by the rest_framework drf in-order-to get the token
     # when we hit post-request to this url we will get the token
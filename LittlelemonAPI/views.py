@@ -1,21 +1,40 @@
+import hashlib
+import json
+
+from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.core.paginator import Paginator, EmptyPage
+from django.http import FileResponse, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.http import condition
 from rest_framework import generics, viewsets, status
 from rest_framework.decorators import api_view, renderer_classes, permission_classes, throttle_classes
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from rest_framework.renderers import TemplateHTMLRenderer, OpenAPIRenderer, JSONOpenAPIRenderer, StaticHTMLRenderer
+from rest_framework.renderers import (TemplateHTMLRenderer, OpenAPIRenderer, JSONOpenAPIRenderer, StaticHTMLRenderer,
+                                      JSONRenderer)
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.status import HTTP_201_CREATED
 from rest_framework.throttling import UserRateThrottle, AnonRateThrottle
 from rest_framework_csv.renderers import CSVRenderer
 from rest_framework_yaml.renderers import YAMLRenderer
 
-from LittlelemonAPI.models import MenuItem, Category
+from LittlelemonAPI import exports
+from LittlelemonAPI.batch import BatchError, parse_batch, run_batch
+from LittlelemonAPI.catalogue_index import get_catalogue_index, UnsupportedQuery
+from LittlelemonAPI.coalescing import single_flight
+from LittlelemonAPI.facets import get_facets
+from LittlelemonAPI.menu_rows import get_serialized_rows
+from LittlelemonAPI.menu_versions import get_menu_version
+from LittlelemonAPI.models import MenuItem
+from LittlelemonAPI.object_cache import menu_item_cache, category_cache
+from LittlelemonAPI.schema import get_schema
 from LittlelemonAPI.serializers import (CategorySerializer,
                                         MenuItemSerializerManual, MenuItemSerializerAutomatic,
                                         )
 from LittlelemonAPI.throttles import TenCallsPerMinuteThrottle
+from LittlelemonAPI.token_maintenance import token_store_stats
 
 
 # 1- The first view to get all items
@@ -24,12 +43,44 @@ class MenuItemView(generics.ListCreateAPIView):
     queryset = MenuItem.objects.all()
     serializer_class = MenuItemSerializerAutomatic
 
+    def list_cache_key(self, request):
+        """
+        The cache key of a page of the list, built only from what the page depends on:
+        the search, ordering and page parameters and the url in the next/previous links.
+        Any other query parameter (e.g. ?utm_source=...) shares the same cached page.
+        :param request: the request of the list
+        """
+        params = (self.paginator.page_query_param, api_settings.SEARCH_PARAM, api_settings.ORDERING_PARAM)
+        page = {
+            'url': request.build_absolute_uri(request.path),
+            'params': {param: request.query_params.getlist(param) for param in params if param in request.query_params},
+        }
+        return 'menu-items:' + hashlib.sha1(json.dumps(page, sort_keys=True).encode()).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        # only one request rebuilds a page when it's missing from the cache, see coalescing.py
+        build_page = super().list
+        data = single_flight(self.list_cache_key(request),
+                             lambda: build_page(request, *args, **kwargs).data,
+                             version=get_menu_version(),
+                             timeout=settings.MENU_CACHE_TIMEOUT,
+                             stale_timeout=settings.MENU_CACHE_STALE_TIMEOUT)
+        return Response(data)
+
 
 # 2- The second view to get a single item
 class SingleMenuItemView(generics.RetrieveUpdateAPIView, generics.DestroyAPIView):
     queryset = MenuItem.objects.all()
     serializer_class = MenuItemSerializerAutomatic
 
+    def get_object(self):
+        # the reads come from the object cache (see object_cache.py), the updates and deletes use the database
+        if self.request.method != 'GET':
+            return super().get_object()
+        menu_item = menu_item_cache.get_or_404(self.kwargs['pk'])
+        self.check_object_permissions(self.request, menu_item)
+        return menu_item
+
 
 # 3- The third view to get all items
 @api_view()
@@ -51,7 +102,9 @@ def menu_items_basic_fetch_data(request):
 def single_item_basic_fetch_data(request, pk):
     # menu_item = MenuItem.objects.get(pk=pk)
     # we use get_object_or_404 to return a 404 response if the object is not found instead of raising an exception
-    menu_item = get_object_or_404(MenuItem, pk=pk)
+    # menu_item = get_object_or_404(MenuItem, pk=pk)
+    # the object cache does the same, but the popular items don't need a database query (see object_cache.py)
+    menu_item = menu_item_cache.get_or_404(pk)
     # we didn't use many=True because we are only serializing one object not a queryset
     serializer = MenuItemSerializerManual(menu_item)
     return Response(serializer.data)
@@ -76,14 +129,19 @@ def menu_items(request):
     # because we use HyperlinkedRelatedField in the serializer
     # to get the full url of the category
     serializer = MenuItemSerializerAutomatic(menu_items, many=True, context={'request': request})
-    return Response(serializer.data)
+    # when the cached list expires, only one request runs the query and the serializer again
+    data = single_flight('menu-items-apiview', lambda: serializer.data,
+                         version=get_menu_version(),
+                         timeout=settings.MENU_CACHE_TIMEOUT,
+                         stale_timeout=settings.MENU_CACHE_STALE_TIMEOUT)
+    return Response(data)
 
 
 @api_view(['GET', 'POST'])
 def menu_items_save_to_modelDserializer(request, pk=None):
     if request.method == 'GET':
         if pk:
-            menu_item = get_object_or_404(MenuItem, pk=pk)
+            menu_item = menu_item_cache.get_or_404(pk)
             # we didn't use many=True because we are only serializing one object
             serializer = MenuItemSerializerAutomatic(menu_item)
             return Response(serializer.data)
@@ -113,33 +171,34 @@ def menu_items_save_to_modelDserializer(request, pk=None):
 
 @api_view()
 def category_detail(request, pk):
-    category = get_object_or_404(Category, pk=pk)
+    category = category_cache.get_or_404(pk)
     serialized_category = CategorySerializer(category)
     return Response(serialized_category.data)
 
 
+# the schema is generated ahead of time and rendered once per process (see schema.py),
+# the views only send the bytes, and a client that sends the ETag back gets a 304 Not Modified
+@condition(etag_func=lambda request: get_schema().yaml_etag)
 @api_view()
 @renderer_classes([OpenAPIRenderer])
 def menu_OpenAPIRenderer(request):
-    items = MenuItem.objects.select_related('category').all()
-    serialized_item = MenuItemSerializerAutomatic(items, many=True)
-    return Response({'data': serialized_item.data}, template_name='menu-items.html')
+    return HttpResponse(get_schema().yaml, content_type=OpenAPIRenderer.media_type)
 
 
+@condition(etag_func=lambda request: get_schema().json_etag)
 @api_view()
 @renderer_classes([JSONOpenAPIRenderer])
 def menu_JsonOpenAPIRenderer(request):
-    items = MenuItem.objects.select_related('category').all()
-    serialized_item = MenuItemSerializerAutomatic(items, many=True)
-    return Response({'data': serialized_item.data}, template_name='menu-items.html')
+    return HttpResponse(get_schema().json, content_type=JSONOpenAPIRenderer.media_type)
 
 
 @api_view()
 @renderer_classes([TemplateHTMLRenderer])
 def menu_TemplateHTMLFormRendererRenderer(request):
-    items = MenuItem.objects.select_related('category').all()
-    serialized_item = MenuItemSerializerAutomatic(items, many=True)
-    return Response(data={'data': serialized_item.data}, template_name='menu-items.html')
+    # the rows are serialized once and cached by the versions of the item and its category (see menu_rows.py),
+    # only the changed rows are serialized again
+    data = get_serialized_rows()
+    return Response(data={'data': data}, template_name='menu-items.html')
 
 
 @api_view(['GET'])
@@ -165,6 +224,54 @@ def menu_YAMLRenderer(request):
     return Response(serialized_item.data)
 
 
+# the CSV and YAML exports above render the whole menu inside the request,
+# for a big menu we can run the export in the background (see exports.py):
+# POST menu-exports {"format": "csv"} -> GET menu-exports/<job_id> until status is done -> GET the download url
+@api_view(['POST'])
+def menu_exports(request):
+    export_format = request.data.get('format', 'csv')
+    if export_format not in exports.EXPORT_FORMATS:
+        return Response(data={'message': f'format should be one of {", ".join(exports.EXPORT_FORMATS)}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        job = exports.submit_export(export_format)
+    except exports.TooManyExportsError:
+        return Response(data={'message': 'Too many exports are running, try again later'},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS)
+    return Response(data=_export_job_data(request, job), status=status.HTTP_202_ACCEPTED)
+
+
+@api_view()
+def menu_export_detail(request, job_id):
+    job = exports.get_job(job_id)
+    if job is None:
+        return Response(data={'message': 'Export not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(data=_export_job_data(request, job))
+
+
+@api_view()
+def menu_export_download(request, job_id):
+    job = exports.get_job(job_id)
+    if job is None or job['status'] != exports.DONE:
+        return Response(data={'message': 'Export not found'}, status=status.HTTP_404_NOT_FOUND)
+    _, content_type = exports.EXPORT_FORMATS[job['format']]
+    result_path = exports.get_result_path(job)
+    try:
+        file = open(result_path, 'rb')
+    except FileNotFoundError:
+        # the result expired after we read the job
+        return Response(data={'message': 'Export not found'}, status=status.HTTP_404_NOT_FOUND)
+    return FileResponse(file, as_attachment=True, filename=f'menu.{result_path.suffix[1:]}',
+                        content_type=content_type)
+
+
+def _export_job_data(request, job):
+    data = dict(job, url=request.build_absolute_uri(reverse('menu-export-detail', args=[job['id']])))
+    if job['status'] == exports.DONE:
+        data['download_url'] = request.build_absolute_uri(reverse('menu-export-download', args=[job['id']]))
+    return data
+
+
 # instead of attacging the renderer to the view
 # we add it into the settings.py
 # REST_FRAMEWORK = {
@@ -192,15 +299,25 @@ def menu_items_filter_data(request):
         ordering = request.query_params.get('ordering')
         perpage = request.query_params.get('perpage', default=2)
         page = request.query_params.get('page', default=1)
+        # ?facets=true adds the number of items per category and per price range
+        with_facets = request.query_params.get('facets', '').lower() in ('1', 'true', 'yes')
+        if settings.MENU_CATALOGUE_INDEX:
+            # answer from the in-memory copy of the menu, without any database query
+            try:
+                return _filter_from_index(category_name, to_price, search, ordering, perpage, page, with_facets)
+            except UnsupportedQuery:
+                pass
         if category_name:
-            items = items.filter(category__title=category_name)
+            # iexact, like the default (case-insensitive) collation of MySQL, the catalogue index does the same
+            items = items.filter(category__title__iexact=category_name)
         # to_price = request.GET.get('to_price')
         if to_price:
             items = items.filter(price__lte=to_price)
         if search:
             # This is a case-insensitive search that matches any part of the title
             # title is a field in the MenuItem model
-            items = items.filter(title__contains=search)
+            # (contains is case-sensitive on MySQL, it's compiled to LIKE BINARY)
+            items = items.filter(title__icontains=search)
         if ordering:
             # http://127.0.0.1:8000/api/menu_items_filter_data?ordering=-price
             # this will order the items by price in descending order
@@ -210,11 +327,19 @@ def menu_items_filter_data(request):
             items = items.order_by(*ordering_fields)  # or in one line items = items.order_by(*ordering.split(','))
 
         paginator = Paginator(items, per_page=perpage)
+        facets = None
+        if with_facets:
+            facets = get_facets(items, {'category': category_name, 'to_price': to_price, 'search': search})
+            # the facets already counted the items, the paginator doesn't need its own COUNT(*) query
+            paginator.count = facets['total']
         try:
             items = paginator.page(number=page)
         except EmptyPage:
             items = []
         serialized_item = MenuItemSerializerAutomatic(items, many=True)
+        if with_facets:
+            return Response({'count': facets['total'], 'results': serialized_item.data,
+                             'facets': {'categories': facets['categories'], 'price_ranges': facets['price_ranges']}})
         return Response(serialized_item.data)
     if request.method == 'POST':
         serialized_item = MenuItemSerializerAutomatic(data=request.data)
@@ -223,6 +348,22 @@ def menu_items_filter_data(request):
         return Response(serialized_item.validated_data, status=HTTP_201_CREATED)
 
 
+def _filter_from_index(category_name, to_price, search, ordering, perpage, page, with_facets):
+    index = get_catalogue_index()
+    items = index.filter(category=category_name, to_price=to_price, search=search, ordering=ordering)
+    paginator = Paginator(items, per_page=perpage)
+    try:
+        page_items = paginator.page(number=page)
+    except EmptyPage:
+        page_items = []
+    data = index.serialize(page_items)
+    if with_facets:
+        facets = index.facets(items)
+        return Response({'count': facets['total'], 'results': data,
+                         'facets': {'categories': facets['categories'], 'price_ranges': facets['price_ranges']}})
+    return Response(data)
+
+
 class MenuItemModelView(viewsets.ModelViewSet):
     queryset = MenuItem.objects.all()
     serializer_class = MenuItemSerializerAutomatic
@@ -295,3 +436,30 @@ def managers_only(request):
             managers.user_set.remove(user)
         return Response(data={'message': 'successful'}, status=status.HTTP_200_OK)
     return Response(data={'message': 'unsuccessful'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+# the size of the JWT token tables and the metrics of the last purge
+@api_view()
+@permission_classes([IsAdminUser])
+def token_store_metrics(request):
+    return Response(data=token_store_stats(), status=status.HTTP_200_OK)
+
+
+# run many requests of this api in one call, see batch.py
+# the user is authenticated once, then every sub-request runs its own view (permissions, throttles...)
+@api_view(['POST'])
+@renderer_classes([JSONRenderer])
+def batch(request):
+    try:
+        sub_requests, concurrent = parse_batch(request.data)
+    except BatchError as error:
+        return Response(data={'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(data={'responses': run_batch(request, sub_requests, concurrent)}, status=status.HTTP_200_OK)
+
+
+# the hit rates of the object cache tiers in this process
+@api_view()
+@permission_classes([IsAdminUser])
+def object_cache_metrics(request):
+    return Response(data={'menu_items': menu_item_cache.stats(), 'categories': category_cache.stats()},
+                    status=status.HTTP_200_OK)